@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 
 import os
 import socket
+from datetime import timedelta
 from .secure_settings import DB_PASSWORD
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -67,7 +68,6 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'reversion.middleware.RevisionMiddleware',
 ]
 
 ROOT_URLCONF = 'appeal.urls'
@@ -170,9 +170,9 @@ REST_FRAMEWORK = {
     ),
 
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication',
+        'main.authentication.CachedBasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'main.authentication.CachedTokenAuthentication',
 
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
@@ -181,6 +181,23 @@ REST_FRAMEWORK = {
 
 CORS_ORIGIN_ALLOW_ALL = True
 
+# Shared by all the workers, the cached responses and the generations which
+# invalidate them must be the same in every process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+    }
+}
+
+# Post and comment versions keep their body zlib-compressed
+COMPRESS_VERSION_BODY = True
+
+# API tokens expire when unused for TOKEN_EXPIRATION, using a token renews it
+# at most once per TOKEN_RENEWAL_INTERVAL
+TOKEN_EXPIRATION = timedelta(days=30)
+TOKEN_RENEWAL_INTERVAL = timedelta(hours=1)
+
 DJOSER = {
     'DOMAIN': 'qblik.ru',
     'SITE_NAME': 'Qblik',
@@ -1,17 +1,22 @@
 from django.contrib import admin
-from reversion.admin import VersionAdmin
 from . import models
 
 # Register your models here.
 
 @admin.register(models.Post)
-class PostAdmin(VersionAdmin):
-    pass
+class PostAdmin(admin.ModelAdmin):
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        models.PostVersion.create_for(form.instance)
 
 
 @admin.register(models.Comment)
-class CommentAdmin(VersionAdmin):
-    pass
+class CommentAdmin(admin.ModelAdmin):
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        models.CommentVersion.create_for(obj)
 
 
 
@@ -35,11 +40,26 @@ class PostHistoryAdmin(admin.ModelAdmin):
 
 
 
+class VersionBodyAdmin(admin.ModelAdmin):
+    # The stored body is empty when it is compressed, show the text instead
+    exclude = ('body', )
+    readonly_fields = ('text', )
+
+    def text(self, obj):
+        return obj.get_body()
+    text.short_description = 'Body'
+
+
 @admin.register(models.PostVersion)
-class PostVersionAdmin(admin.ModelAdmin):
+class PostVersionAdmin(VersionBodyAdmin):
     pass
 
 
 @admin.register(models.CommentVersion)
-class CommentVersionAdmin(admin.ModelAdmin):
+class CommentVersionAdmin(VersionBodyAdmin):
+    pass
+
+
+@admin.register(models.OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
     pass
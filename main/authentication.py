@@ -0,0 +1,173 @@
+import hashlib
+import time
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from rest_framework import exceptions
+from rest_framework.authentication import BasicAuthentication, TokenAuthentication
+from rest_framework.authtoken.models import Token
+from django.utils.translation import ugettext_lazy as _
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    """
+    BasicAuthentication which remembers successful logins in the process for
+    cache_timeout seconds, so that a client sending its password with every
+    request does not pay for the password hasher every time. Entries are
+    keyed by a salted HMAC of the credentials and keep the password hash
+    they were checked against, changing the password invalidates them.
+    """
+    cache_timeout = 60
+    max_entries = 10000
+
+    _verified = {}
+
+    def authenticate_credentials(self, userid, password):
+        key = salted_hmac(self.__class__.__name__, '{}\0{}'.format(userid, password)).hexdigest()
+        entry = self._verified.get(key)
+        if entry is not None and entry[0] > time.time():
+            user = get_user_model()._default_manager.filter(pk=entry[1]).first()
+            if user is not None and user.password == entry[2] and user.get_username() == userid:
+                if not user.is_active:
+                    raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+                return (user, None)
+            self._verified.pop(key, None)
+
+        user, auth = super().authenticate_credentials(userid, password)
+        self.remember(key, user)
+        return (user, auth)
+
+    def remember(self, key, user):
+        now = time.time()
+        if len(self._verified) >= self.max_entries:
+            for expired in [key for key, entry in list(self._verified.items()) if entry[0] <= now]:
+                self._verified.pop(expired, None)
+            if len(self._verified) >= self.max_entries:
+                self._verified.clear()
+        self._verified[key] = (now + self.cache_timeout, user.pk, user.password)
+
+
+def get_token_digest(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def is_token_expired(token, now=None):
+    return token.created < (now or timezone.now()) - settings.TOKEN_EXPIRATION
+
+
+def get_valid_token(user, token=None):
+    """
+    The API token of the user for a new login, an expired one is replaced
+    by a new key and a valid one is renewed. token is the user's token when
+    it is already loaded.
+    """
+    now = timezone.now()
+    if token is None or is_token_expired(token, now):
+        Token.objects.filter(user=user, created__lt=now - settings.TOKEN_EXPIRATION).delete()
+        token, created = Token.objects.get_or_create(user=user)
+        if created:
+            return token
+    if token.created < now - settings.TOKEN_RENEWAL_INTERVAL:
+        Token.objects.filter(pk=token.pk).update(created=now)
+        token.created = now
+    return token
+
+
+class RevokedTokens:
+    """
+    Digests of the recently revoked tokens kept in the process. It is
+    refreshed with the RevokedToken rows added since the previous refresh
+    at most every refresh_interval seconds, so checking a token needs no
+    query. Entries are dropped once no cache can hold the token any more.
+    """
+    refresh_interval = 5
+    # Revocations committed late by a slow transaction are still picked up
+    overlap = 60
+
+    def __init__(self, retention):
+        self.retention = retention
+        self.digests = {}
+        self.refreshed = None
+        self.refreshed_at = 0
+
+    def __contains__(self, digest):
+        if time.time() - self.refreshed_at >= self.refresh_interval:
+            self.refresh()
+        return digest in self.digests
+
+    def refresh(self):
+        now = timezone.now()
+        since = now - timedelta(seconds=self.retention)
+        if self.refreshed is not None:
+            since = max(since, self.refreshed - timedelta(seconds=self.overlap))
+        RevokedToken = apps.get_model('main', 'RevokedToken')
+        self.digests.update(RevokedToken.objects.filter(revoked__gte=since).values_list('digest', 'revoked'))
+
+        expired = now - timedelta(seconds=self.retention)
+        self.digests = {digest: revoked for digest, revoked in self.digests.items() if revoked >= expired}
+        self.refreshed = now
+        self.refreshed_at = time.time()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication which loads the token, the user and the user profile
+    with one query and keeps them in the cache for cache_timeout seconds,
+    so an authenticated request makes no identity queries. Deleting the
+    token or saving its user or profile drops the entry, see invalidate(),
+    and the revoked tokens index refuses deleted tokens which another
+    process may still have cached.
+
+    Tokens expire after settings.TOKEN_EXPIRATION without use, a used token
+    is renewed once per settings.TOKEN_RENEWAL_INTERVAL.
+    """
+    cache_timeout = 5 * 60
+
+    revoked_tokens = RevokedTokens(cache_timeout + RevokedTokens.refresh_interval)
+
+    @staticmethod
+    def get_cache_key(key):
+        return 'token:{}'.format(get_token_digest(key))
+
+    def authenticate_credentials(self, key):
+        if get_token_digest(key) in self.revoked_tokens:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        cache_key = self.get_cache_key(key)
+        token = cache.get(cache_key)
+        if token is None:
+            model = self.get_model()
+            try:
+                token = model.objects.select_related('user', 'user__user_profile').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cache.set(cache_key, token, self.cache_timeout)
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        now = timezone.now()
+        if is_token_expired(token, now):
+            token.delete()
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+        if token.created < now - settings.TOKEN_RENEWAL_INTERVAL:
+            self.get_model().objects.filter(pk=token.pk).update(created=now)
+            token.created = now
+            cache.set(cache_key, token, self.cache_timeout)
+
+        return (token.user, token)
+
+    @classmethod
+    def invalidate(cls, keys):
+        """
+        Drops the cached tokens once the current transaction commits, so that
+        a concurrent request can not cache the old rows again.
+        """
+        cache_keys = [cls.get_cache_key(key) for key in keys]
+        if cache_keys:
+            transaction.on_commit(lambda: cache.delete_many(cache_keys))
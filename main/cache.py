@@ -0,0 +1,71 @@
+import hashlib
+import time
+from uuid import uuid4
+from django.core.cache import cache
+from django.db import transaction
+
+
+def get_generation(name):
+    key = 'generation:{}'.format(name)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid4().hex
+        # add() keeps the generation set by a concurrent request
+        if not cache.add(key, generation, None):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def bump_generation(*names):
+    """
+    Makes the cached data of the generations stale once the current
+    transaction commits, so that a concurrent read can not cache the old
+    rows under the new generation.
+    """
+    def bump():
+        cache.set_many({'generation:{}'.format(name): uuid4().hex for name in names}, None)
+    transaction.on_commit(bump)
+
+
+def get_response_key(request, generations, *extra):
+    """
+    The key of a response depends on the generations of its data and on
+    everything in the request which changes the rendered content.
+    """
+    parts = [get_generation(name) for name in generations]
+    parts += [request.get_host(), request.get_full_path(), request.accepted_renderer.format]
+    parts += [str(value) for value in extra]
+    return hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_or_compute(key, compute, timeout, lock_timeout=10, wait=2.0, interval=0.05):
+    """
+    Returns the cached value of key or computes and caches it. A missing
+    value is computed by one request at a time, the others wait up to `wait`
+    seconds for it instead of all running the same queries.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = 'lock:{}'.format(key)
+    deadline = time.time() + wait
+    while not cache.add(lock_key, 1, lock_timeout):
+        # Nobody holds the lock, the cache server is unavailable
+        if cache.get(lock_key) is None:
+            return compute()
+        time.sleep(interval)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if time.time() > deadline:
+            return compute()
+
+    try:
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.set(key, value, timeout)
+    finally:
+        cache.delete(lock_key)
+    return value
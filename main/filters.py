@@ -1,4 +1,7 @@
 import django_filters
+from django.db import connection
+from django.db.models import FloatField, Value
+from django.db.models.expressions import RawSQL
 from rest_framework import filters
 from .models import User, Post, Comment
 
@@ -13,10 +16,49 @@ class PostFilter(filters.FilterSet):
     body = django_filters.CharFilter(name="body", lookup_type='icontains')
     class Meta:
         model = Post
-        fields = ['id_gte', 'tags__alias', 'id', 'body', 'user']
+        # tags__alias is applied by PostViewSet together with the matching ordering
+        fields = ['id_gte', 'id', 'body', 'user']
 
 
 class CommentFilter(filters.FilterSet):
+    created_gte = django_filters.IsoDateTimeFilter(name="created", lookup_type='gte')
+    created_lte = django_filters.IsoDateTimeFilter(name="created", lookup_type='lte')
+    body = django_filters.CharFilter(name="body", lookup_type='icontains')
     class Meta:
         model = Comment
-        fields = ['post', 'user', 'id']
+        fields = ['post', 'user', 'id', 'created_gte', 'created_lte', 'body', 'username']
+
+
+class PostSearchFilter(filters.BaseFilterBackend):
+    """
+    ?search=words returns the posts matching all the words ordered by
+    relevance. PostgreSQL matches stemmed words through the GIN index on
+    to_tsvector('russian', body) and ranks with ts_rank, other databases
+    fall back to icontains on every word.
+    """
+    search_param = 'search'
+    search_config = 'russian'
+    ordering = ('-search_rank', '-id')
+
+    @classmethod
+    def get_search_query(cls, request):
+        return request.query_params.get(cls.search_param, '').strip()
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_search_query(request)
+        if not query:
+            return queryset
+
+        if connection.vendor == 'postgresql':
+            vector = "to_tsvector('{}', {}.body)".format(
+                self.search_config, connection.ops.quote_name(Post._meta.db_table))
+            tsquery = "plainto_tsquery('{}', %s)".format(self.search_config)
+            queryset = queryset.extra(where=['{} @@ {}'.format(vector, tsquery)], params=[query])
+            # real widened to double precision, the type the cursor value is compared as
+            rank = RawSQL('ts_rank({}, {})::float8'.format(vector, tsquery), (query, ), output_field=FloatField())
+        else:
+            for word in query.split():
+                queryset = queryset.filter(body__icontains=word)
+            rank = Value(0.0, output_field=FloatField())
+        return queryset.annotate(search_rank=rank).order_by(*self.ordering)
+
@@ -0,0 +1,57 @@
+import base64
+import time
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, RequestFactory
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication, TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from main.authentication import CachedBasicAuthentication, CachedTokenAuthentication
+
+
+class Command(BaseCommand):
+    help = 'Measures the authentication cost of a request for Basic, Session and Token authentication'
+
+    username = 'benchmark_auth'
+    password = 'benchmark_auth_password'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100)
+
+    def handle(self, *args, **options):
+        # Everything created here is rolled back
+        with transaction.atomic():
+            user = User.objects.create_user(self.username, password=self.password)
+            token = Token.objects.create(user=user)
+            client = Client()
+            client.force_login(user)
+            session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+            credentials = base64.b64encode('{}:{}'.format(self.username, self.password).encode('utf-8')).decode('ascii')
+
+            cases = (
+                ('Basic', BasicAuthentication(), {'HTTP_AUTHORIZATION': 'Basic {}'.format(credentials)}),
+                ('Cached basic', CachedBasicAuthentication(), {'HTTP_AUTHORIZATION': 'Basic {}'.format(credentials)}),
+                ('Session', SessionAuthentication(), {'HTTP_COOKIE': '{}={}'.format(settings.SESSION_COOKIE_NAME,
+                                                                                     session_key)}),
+                ('Token', TokenAuthentication(), {'HTTP_AUTHORIZATION': 'Token {}'.format(token.key)}),
+                ('Cached token', CachedTokenAuthentication(), {'HTTP_AUTHORIZATION': 'Token {}'.format(token.key)}),
+            )
+            for name, authentication, headers in cases:
+                elapsed = self.measure(authentication, headers, options['requests'])
+                self.stdout.write('{}: {:.3f} ms per request'.format(name, elapsed * 1000 / options['requests']))
+            transaction.set_rollback(True)
+
+    def measure(self, authentication, headers, requests):
+        factory = RequestFactory()
+        start = time.perf_counter()
+        for i in range(requests):
+            request = factory.get('/', **headers)
+            SessionMiddleware().process_request(request)
+            AuthenticationMiddleware().process_request(request)
+            user, auth = authentication.authenticate(Request(request))
+            assert user.get_username() == self.username
+        return time.perf_counter() - start
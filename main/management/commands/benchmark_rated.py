@@ -0,0 +1,58 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+from main.models import Post, PostMark, POST_MARK_LIKE, POST_MARK_DISLIKE
+from main.views import PostViewSet
+
+
+class Command(BaseCommand):
+    help = 'Measures the post list latency of an authenticated user as the number of marks per post grows'
+
+    username = 'benchmark_rated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20)
+        parser.add_argument('--posts', type=int, default=10)
+        parser.add_argument('--marks', type=int, nargs='+', default=[0, 100, 1000, 5000])
+
+    def handle(self, *args, **options):
+        # Everything created here is rolled back
+        with transaction.atomic():
+            user = User.objects.create_user(self.username)
+            author = User.objects.create_user('{}_author'.format(self.username))
+            posts = [Post.objects.create(user=author, username=author.username, body='body')
+                     for i in range(options['posts'])]
+            for post in posts[::2]:
+                PostMark.objects.create(post=post, user=user, mark_type=POST_MARK_LIKE)
+
+            voters = []
+            for marks in sorted(options['marks']):
+                voters += self.add_voters(posts, len(voters), marks - len(voters))
+                elapsed = self.measure(user, options['requests'])
+                self.stdout.write('{} marks per post: {:.3f} ms per request'.format(
+                    marks, elapsed * 1000 / options['requests']))
+            transaction.set_rollback(True)
+
+    def add_voters(self, posts, start, count):
+        if count <= 0:
+            return []
+        User.objects.bulk_create([User(username='{}_voter_{}'.format(self.username, i))
+                                  for i in range(start, start + count)])
+        voters = list(User.objects.filter(username__startswith='{}_voter_'.format(self.username))
+                      .order_by('-id')[:count])
+        PostMark.objects.bulk_create([PostMark(post=post, user=voter, mark_type=POST_MARK_DISLIKE)
+                                      for post in posts for voter in voters])
+        return voters
+
+    def measure(self, user, requests):
+        factory = APIRequestFactory()
+        view = PostViewSet.as_view({'get': 'list'})
+        start = time.perf_counter()
+        for i in range(requests):
+            request = factory.get('/api/v1/posts/', {'fields': 'id,rated'}, HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            response = view(request)
+            assert {post['rated'] for post in response.data['results']} == {0, POST_MARK_LIKE}
+        return time.perf_counter() - start
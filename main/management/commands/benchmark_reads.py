@@ -0,0 +1,60 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+from main.models import Post, Comment
+from main.views import PostViewSet, CommentViewSet
+
+
+class Command(BaseCommand):
+    help = 'Measures the latency of GET requests on posts and comments with and without a transaction around them'
+
+    username = 'benchmark_reads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100)
+        parser.add_argument('--posts', type=int, default=20)
+
+    def handle(self, *args, **options):
+        # A transaction around the whole run would turn the measured ones into
+        # savepoints, the data is committed and deleted at the end instead
+        if User.objects.filter(username=self.username).exists():
+            raise CommandError('User {} already exists'.format(self.username))
+        user = User.objects.create_user(self.username)
+        try:
+            posts = [Post.objects.create(user=user, username=user.username, body='body')
+                     for i in range(options['posts'])]
+            for post in posts:
+                Comment.objects.create(post=post, user=user, username=user.username, body='comment')
+
+            cases = (
+                ('Post list', PostViewSet.as_view({'get': 'list'}), '/api/v1/posts/', {}),
+                ('Post detail', PostViewSet.as_view({'get': 'retrieve'}), '/api/v1/posts/{}/'.format(posts[0].pk),
+                 {'pk': str(posts[0].pk)}),
+                ('Comment list', CommentViewSet.as_view({'get': 'list'}), '/api/v1/comments/', {}),
+            )
+            for name, view, path, kwargs in cases:
+                for atomic in (False, True):
+                    elapsed = self.measure(user, view, path, kwargs, atomic, options['requests'])
+                    self.stdout.write('{} {}: {:.3f} ms per request'.format(
+                        name, 'in a transaction' if atomic else 'without a transaction',
+                        elapsed * 1000 / options['requests']))
+        finally:
+            Post.objects.filter(user=user).delete()
+            user.delete()
+
+    def measure(self, user, view, path, kwargs, atomic, requests):
+        factory = APIRequestFactory()
+        start = time.perf_counter()
+        for i in range(requests):
+            # Authenticated, so that the anonymous response cache is not used
+            request = factory.get(path, HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            if atomic:
+                with transaction.atomic():
+                    response = view(request, **kwargs)
+            else:
+                response = view(request, **kwargs)
+            assert response.status_code == 200
+        return time.perf_counter() - start
@@ -0,0 +1,27 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from main.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = 'Deletes the expired API tokens and the revoked token digests no process needs any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        expired = Token.objects.filter(created__lt=timezone.now() - settings.TOKEN_EXPIRATION)
+        deleted = 0
+        while True:
+            keys = list(expired.values_list('key', flat=True)[:options['batch_size']])
+            if not keys:
+                break
+            Token.objects.filter(key__in=keys).delete()
+            deleted += len(keys)
+
+        # Cached tokens are refused by the revoked index for minutes, a day is plenty
+        revoked, _ = RevokedToken.objects.filter(revoked__lt=timezone.now() - timedelta(days=1)).delete()
+        self.stdout.write('Deleted {} expired tokens and {} revoked token digests'.format(deleted, revoked))
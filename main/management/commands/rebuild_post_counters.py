@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from main.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds comment, like and dislike counters of posts from the comments and marks tables'
+
+    def handle(self, *args, **options):
+        fixed = Post.rebuild_counters()
+        self.stdout.write('Counters fixed for {} posts'.format(fixed))
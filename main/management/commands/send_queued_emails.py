@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from main.models import OutgoingEmail
+
+
+class Command(BaseCommand):
+    help = 'Sends the emails queued in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--max-attempts', type=int, default=5)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling the outbox instead of exiting once it is drained')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait between polls of an empty outbox')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        while True:
+            try:
+                sent, failed = OutgoingEmail.send_pending(batch_size, options['max_attempts'])
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                self.stderr.write('Unable to send emails: {}'.format(e))
+                sent, failed = 0, 0
+
+            if sent or failed:
+                self.stdout.write('Sent {}, failed {}'.format(sent, failed))
+            if sent + failed < batch_size:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
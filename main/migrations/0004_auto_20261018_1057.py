@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 07:57
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0003_auto_20160624_1452'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('username', models.CharField(blank=True, max_length=200)),
+                ('body', models.TextField()),
+                ('email', models.EmailField(blank=True, max_length=254, null=True)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Comment')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='comment_versions', to='main.Post')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='comment_versions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PostVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('username', models.CharField(blank=True, max_length=200)),
+                ('body', models.TextField()),
+                ('email', models.EmailField(blank=True, max_length=254, null=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Post')),
+                ('tags', models.ManyToManyField(to='main.Tag')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='post_versions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SocialAccount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('external_id', models.CharField(blank=True, max_length=500, null=True)),
+                ('network', models.CharField(choices=[('google', 'google'), ('vk', 'vk'), ('facebook', 'facebook')], max_length=20)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='social_accounts', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='external_id',
+        ),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='network',
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='email_confirmed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='receive_comments_email',
+            field=models.BooleanField(default=True),
+        ),
+    ]
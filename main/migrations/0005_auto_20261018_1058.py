@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 07:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_counters(apps, schema_editor):
+    Post = apps.get_model('main', 'Post')
+    Comment = apps.get_model('main', 'Comment')
+    PostMark = apps.get_model('main', 'PostMark')
+
+    comments = Comment.objects.order_by().values_list('post').annotate(Count('id'))
+    for post_id, count in comments:
+        Post.objects.filter(pk=post_id).update(comment_count=count)
+
+    counter_names = {1: 'liked_count', 2: 'disliked_count'}
+    marks = PostMark.objects.order_by().values_list('post', 'mark_type').annotate(Count('id'))
+    for post_id, mark_type, count in marks:
+        Post.objects.filter(pk=post_id).update(**{counter_names[mark_type]: count})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_auto_20261018_1057'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='disliked_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='liked_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 07:59
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def fill_last_action(apps, schema_editor):
+    Post = apps.get_model('main', 'Post')
+    PostHistory = apps.get_model('main', 'PostHistory')
+
+    PostHistory.objects.bulk_create([
+        PostHistory(post=post, last_action=post.created)
+        for post in Post.objects.filter(history__isnull=True)
+    ])
+    for ph in PostHistory.objects.filter(last_action__isnull=True).select_related('post'):
+        ph.last_action = max(ph.post.created, ph.commented or ph.post.created)
+        ph.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_auto_20261018_1058'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='posthistory',
+            index_together=set([('last_action', 'post')]),
+        ),
+        migrations.RunPython(fill_last_action, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 07:59
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_auto_20261018_1059'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='postmark',
+            index_together=set([('post', 'user')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_auto_20261018_1102'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingemail',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='comments_email_mode',
+            field=models.CharField(choices=[('immediate', 'immediate'), ('hourly', 'hourly'), ('daily', 'daily')], default='immediate', max_length=20),
+        ),
+    ]
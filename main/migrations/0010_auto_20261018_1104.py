@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:04
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def delete_duplicate_marks(apps, schema_editor):
+    Post = apps.get_model('main', 'Post')
+    PostMark = apps.get_model('main', 'PostMark')
+
+    counter_names = {1: 'liked_count', 2: 'disliked_count'}
+    duplicates = PostMark.objects.order_by().values('post', 'user').annotate(
+        count=Count('id'), last_id=Max('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        PostMark.objects.filter(post=duplicate['post'], user=duplicate['user'])\
+            .exclude(pk=duplicate['last_id']).delete()
+        counters = dict.fromkeys(counter_names.values(), 0)
+        marks = PostMark.objects.filter(post=duplicate['post']).order_by().values_list('mark_type').annotate(Count('id'))
+        for mark_type, count in marks:
+            counters[counter_names[mark_type]] = count
+        Post.objects.filter(pk=duplicate['post']).update(**counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_auto_20261018_1103'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_marks, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='postmark',
+            unique_together=set([('post', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='postmark',
+            index_together=set([]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Max
+
+
+def merge_duplicate_history(apps, schema_editor):
+    PostHistory = apps.get_model('main', 'PostHistory')
+
+    fields = ('commented', 'up_voted', 'down_voted', 'un_voted', 'last_action')
+    duplicates = PostHistory.objects.order_by().values('post').annotate(
+        count=Count('id'), last_id=Max('id'), **{field: Max(field) for field in fields}).filter(count__gt=1)
+    for duplicate in duplicates:
+        PostHistory.objects.filter(post=duplicate['post']).exclude(pk=duplicate['last_id']).delete()
+        PostHistory.objects.filter(pk=duplicate['last_id']).update(**{field: duplicate[field] for field in fields})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_auto_20261018_1104'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_history, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='posthistory',
+            name='post',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='history', to='main.Post'),
+        ),
+    ]
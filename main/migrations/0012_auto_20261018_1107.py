@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_auto_20261018_1106'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentversion',
+            name='compressed_body',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='postversion',
+            name='compressed_body',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='commentversion',
+            name='body',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='postversion',
+            name='body',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Min
+
+
+def move_tag_links(through, owner, tag_id, duplicate_ids):
+    tagged = set(through.objects.filter(tag=tag_id).values_list(owner, flat=True))
+    owner_ids = set(through.objects.filter(tag__in=duplicate_ids).values_list(owner, flat=True)) - tagged
+    through.objects.bulk_create([through(**{owner: owner_id, 'tag_id': tag_id}) for owner_id in owner_ids])
+
+
+def merge_duplicate_tags(apps, schema_editor):
+    Post = apps.get_model('main', 'Post')
+    PostVersion = apps.get_model('main', 'PostVersion')
+    Tag = apps.get_model('main', 'Tag')
+
+    duplicates = Tag.objects.order_by().values('alias').annotate(
+        count=Count('id'), first_id=Min('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        tag_ids = list(Tag.objects.filter(alias=duplicate['alias'])
+                       .exclude(pk=duplicate['first_id']).values_list('pk', flat=True))
+        # Posts and their versions, deleting the duplicates would drop their links
+        move_tag_links(Post.tags.through, 'post_id', duplicate['first_id'], tag_ids)
+        move_tag_links(PostVersion.tags.through, 'postversion_id', duplicate['first_id'], tag_ids)
+        Tag.objects.filter(pk__in=tag_ids).delete()
+
+
+def fill_post_tag_activity(apps, schema_editor):
+    Post = apps.get_model('main', 'Post')
+    PostTagActivity = apps.get_model('main', 'PostTagActivity')
+
+    post_tags = Post.tags.through.objects.values_list('post_id', 'tag_id', 'post__history__last_action')
+    PostTagActivity.objects.bulk_create([PostTagActivity(post_id=post_id, tag_id=tag_id, last_action=last_action)
+                                         for post_id, tag_id, last_action in post_tags.iterator()],
+                                        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_auto_20261018_1109'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostTagActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_action', models.DateTimeField(blank=True, null=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_activity', to='main.Post')),
+            ],
+        ),
+        migrations.RunPython(merge_duplicate_tags, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='alias',
+            field=models.CharField(max_length=500, unique=True),
+        ),
+        migrations.AddField(
+            model_name='posttagactivity',
+            name='tag',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='post_activity', to='main.Tag'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='posttagactivity',
+            unique_together=set([('post', 'tag')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='posttagactivity',
+            index_together=set([('tag', 'last_action', 'post')]),
+        ),
+        migrations.RunPython(fill_post_tag_activity, migrations.RunPython.noop),
+    ]
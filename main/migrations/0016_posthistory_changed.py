@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_changed(apps, schema_editor):
+    PostHistory = apps.get_model('main', 'PostHistory')
+
+    PostHistory.objects.update(changed=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_auto_20261018_1110'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='posthistory',
+            name='changed',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_changed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.7 on 2026-10-18 08:24
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def delete_duplicate_accounts(apps, schema_editor):
+    SocialAccount = apps.get_model('main', 'SocialAccount')
+
+    duplicates = SocialAccount.objects.filter(external_id__isnull=False).order_by()\
+        .values('network', 'external_id').annotate(count=Count('id'), last_id=Max('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        SocialAccount.objects.filter(network=duplicate['network'], external_id=duplicate['external_id'])\
+            .exclude(pk=duplicate['last_id']).delete()
+
+
+def create_missing_profiles(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    UserProfile = apps.get_model('main', 'UserProfile')
+
+    UserProfile.objects.bulk_create([UserProfile(user_id=user_id) for user_id in
+                                     User.objects.filter(user_profile__isnull=True).values_list('pk', flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_accounts, migrations.RunPython.noop),
+        migrations.RunPython(create_missing_profiles, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='socialaccount',
+            unique_together=set([('network', 'external_id')]),
+        ),
+    ]
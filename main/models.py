@@ -1,7 +1,21 @@
-from django.db import models
+import json
+import re
+import zlib
+from collections import Counter, defaultdict
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, EmailMessage, get_connection
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count, Case, When, Value
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.template import loader
+from .cache import bump_generation
+from .authentication import CachedTokenAuthentication, get_token_digest, is_token_expired
+from rest_framework.authtoken.models import Token
 #from .tokens import UserActivateTokenGenerator
 
 
@@ -12,6 +26,17 @@ POST_MARKS = (
     (POST_MARK_DISLIKE, 'Dislike')
 )
 
+MARK_COUNTERS = {
+    POST_MARK_LIKE: 'liked_count',
+    POST_MARK_DISLIKE: 'disliked_count',
+}
+COUNTER_FIELDS = ('comment_count', 'liked_count', 'disliked_count')
+MARK_HISTORY_FIELDS = {
+    0: 'un_voted',
+    POST_MARK_LIKE: 'up_voted',
+    POST_MARK_DISLIKE: 'down_voted',
+}
+
 class Post(models.Model):
     class Meta:
         ordering = ['-created']
@@ -22,92 +47,327 @@ class Post(models.Model):
     body = models.TextField()
     tags = models.ManyToManyField('Tag')
     email = models.EmailField(blank=True, null=True)
+    comment_count = models.IntegerField(default=0)
+    liked_count = models.IntegerField(default=0)
+    disliked_count = models.IntegerField(default=0)
 
     def __str__(self):
         return self.body[:150]
 
-    @property
-    def comment_count(self):
-        return self.comments.count()
-
-    @property
-    def liked_count(self):
-        return self.marks.filter(mark_type=POST_MARK_LIKE).count()
-
-    @property
-    def disliked_count(self):
-        return self.marks.filter(mark_type=POST_MARK_DISLIKE).count()
-
     def get_absolute_url(self):
         return '/post/{}'.format(self.id)
 
+    @classmethod
+    def lock(cls, post_ids):
+        """
+        Locks the rows of the posts in the order of their ids, so that
+        transactions updating the counters of several posts wait for each
+        other instead of deadlocking.
+        """
+        list(cls.objects.select_for_update().filter(pk__in=post_ids).order_by('pk').values_list('pk', flat=True))
+
+    @classmethod
+    def update_counters(cls, post_id, **deltas):
+        deltas = {name: F(name) + delta for name, delta in deltas.items() if delta}
+        if deltas:
+            cls.objects.filter(pk=post_id).update(**deltas)
+
+    @classmethod
+    def update_counters_many(cls, deltas):
+        """
+        Applies the counter deltas of several posts, given as
+        {post_id: {counter: delta}}, with one UPDATE.
+        """
+        changes = {}
+        for name in COUNTER_FIELDS:
+            whens = [When(pk=post_id, then=Value(post_deltas[name]))
+                     for post_id, post_deltas in deltas.items() if post_deltas.get(name)]
+            if whens:
+                changes[name] = F(name) + Case(*whens, default=Value(0), output_field=models.IntegerField())
+        if changes:
+            cls.objects.filter(pk__in=list(deltas)).update(**changes)
+
+    @classmethod
+    def rebuild_counters(cls):
+        counters = defaultdict(lambda: dict.fromkeys(COUNTER_FIELDS, 0))
+        comments = Comment.objects.order_by().values_list('post').annotate(Count('id'))
+        for post_id, count in comments:
+            counters[post_id]['comment_count'] = count
+        marks = PostMark.objects.order_by().values_list('post', 'mark_type').annotate(Count('id'))
+        for post_id, mark_type, count in marks:
+            counters[post_id][MARK_COUNTERS[mark_type]] = count
+
+        fixed = 0
+        for post in cls.objects.order_by().only(*COUNTER_FIELDS).iterator():
+            actual = counters[post.pk]
+            if any(getattr(post, name) != value for name, value in actual.items()):
+                cls.objects.filter(pk=post.pk).update(**actual)
+                fixed += 1
+        return fixed
+
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        PostHistory.objects.get_or_create(post=self)
+        # Counters are maintained with F() updates, never write back stale values
+        if not self._state.adding and not kwargs.get('update_fields'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in COUNTER_FIELDS]
+        with transaction.atomic():
+            adding = self._state.adding
+            super().save(*args, **kwargs)
+            if adding:
+                PostHistory.objects.create(post=self, last_action=self.created, changed=self.created)
+            else:
+                PostHistory.touch([self.pk])
+
+
+
+class VersionBody(models.Model):
+    """
+    With settings.COMPRESS_VERSION_BODY the body of a version is stored
+    zlib-compressed in compressed_body whenever that makes it smaller.
+    """
+    class Meta:
+        abstract = True
 
+    body = models.TextField(blank=True)
+    compressed_body = models.BinaryField(null=True, blank=True)
 
+    def set_body(self, body):
+        self.body, self.compressed_body = body, None
+        if getattr(settings, 'COMPRESS_VERSION_BODY', False):
+            encoded = body.encode('utf-8')
+            compressed = zlib.compress(encoded)
+            if len(compressed) < len(encoded):
+                self.body, self.compressed_body = '', compressed
 
-class PostVersion(models.Model):
+    def get_body(self):
+        if self.compressed_body is not None:
+            return zlib.decompress(bytes(self.compressed_body)).decode('utf-8')
+        return self.body
+
+
+class PostVersion(VersionBody):
     created = models.DateTimeField(auto_now_add=True)
     post = models.ForeignKey(Post)
     user = models.ForeignKey(User, null=True, blank=True, related_name='post_versions')
     username = models.CharField(max_length=200, blank=True)
-    body = models.TextField()
     tags = models.ManyToManyField('Tag')
     email = models.EmailField(blank=True, null=True)
 
+    @classmethod
+    def create_for(cls, post):
+        version = cls(post=post, user_id=post.user_id, username=post.username, email=post.email)
+        version.set_body(post.body)
+        version.save()
+        tag_ids = Post.tags.through.objects.filter(post=post).values_list('tag_id', flat=True)
+        cls.tags.through.objects.bulk_create([cls.tags.through(postversion=version, tag_id=tag_id)
+                                              for tag_id in tag_ids])
+        return version
+
 
 class PostHistory(models.Model):
-    post = models.ForeignKey('Post', related_name='history')
+    class Meta:
+        index_together = (('last_action', 'post'), )
+
+    post = models.OneToOneField('Post', related_name='history')
     commented = models.DateTimeField(null=True, blank=True)
     up_voted = models.DateTimeField(null=True, blank=True)
     down_voted = models.DateTimeField(null=True, blank=True)
     un_voted = models.DateTimeField(null=True, blank=True)
     last_action = models.DateTimeField(null=True, blank=True)
-
-    def save(self, *args, **kwargs):
-        self.last_action = self.post.created
-        if self.commented:
-            self.last_action = max(self.last_action, self.commented)
-        super().save(*args, **kwargs)
+    # Any change of the post, its comments or marks, the conditional GET validator
+    changed = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    @classmethod
+    def record(cls, post_ids, action, when=None):
+        """
+        Stamps the action time on the history of the posts with one UPDATE.
+        A comment also moves last_action forward, it never goes back.
+        """
+        when = when or timezone.now()
+        changes = {action: when, 'changed': timezone.now()}
+        if action == 'commented':
+            changes['last_action'] = Greatest('last_action', Value(when, output_field=models.DateTimeField()))
+            PostTagActivity.objects.filter(post__in=post_ids).update(last_action=changes['last_action'])
+        cls.objects.filter(post__in=post_ids).update(**changes)
+        bump_generation('posts')
+
+    @classmethod
+    def touch(cls, post_ids):
+        cls.objects.filter(post__in=post_ids).update(changed=timezone.now())
+        bump_generation('posts')
+
+    @classmethod
+    def last_changed(cls, **filters):
+        """
+        The latest change of the posts matching filters, read from the changed
+        index.
+        """
+        return cls.objects.filter(**filters).aggregate(changed=models.Max('changed'))['changed']
 
 
 class PostMark(models.Model):
+    class Meta:
+        unique_together = (('post', 'user'), )
+
     created = models.DateTimeField(auto_now_add=True)
     post = models.ForeignKey(Post, related_name='marks')
     mark_type = models.PositiveIntegerField(choices=POST_MARKS)
     user = models.ForeignKey(User, blank=True)
 
     def save(self, *args, **kwargs):
-        type(self).objects.filter(post=self.post, user=self.user).delete()
-        if self.user != self.post.user:
-            super().save(*args, **kwargs)
-
-        ph, created = PostHistory.objects.get_or_create(post=self.post)
-        if self.mark_type == POST_MARK_LIKE:
-            ph.up_voted = self.created
-        else:
-            ph.down_voted = self.created
-        ph.save()
+        with transaction.atomic():
+            existing_marks = type(self).objects.filter(post=self.post, user=self.user)
+            deleted = Counter(existing_marks.values_list('mark_type', flat=True))
+            existing_marks.delete()
+            deltas = {MARK_COUNTERS[mark_type]: -count for mark_type, count in deleted.items()}
+            if self.user != self.post.user:
+                super().save(*args, **kwargs)
+                counter = MARK_COUNTERS[self.mark_type]
+                deltas[counter] = deltas.get(counter, 0) + 1
+            Post.update_counters(self.post_id, **deltas)
+            PostHistory.record([self.post_id], MARK_HISTORY_FIELDS[self.mark_type], self.created)
+
+    @classmethod
+    def rate(cls, post, user, mark_type):
+        """
+        Toggles the user's mark on the post: the same mark is removed and
+        another one replaces it, counters and history follow in the same
+        transaction. The post row is locked first, like in rate_many, then the
+        mark row, and a concurrent first vote is caught by the (post, user)
+        constraint and handled as an existing mark.
+        Returns the resulting mark type, 0 for none.
+        """
+        with transaction.atomic():
+            Post.lock([post.pk])
+            created = False
+            # The mark inserted by a concurrent vote may be toggled off again
+            # before it is read, then the insert is tried again
+            while True:
+                mark = cls.objects.select_for_update().filter(post=post, user=user).first()
+                if mark is not None:
+                    break
+                try:
+                    with transaction.atomic():
+                        cls.objects.bulk_create([cls(post=post, user=user, mark_type=mark_type)])
+                    created = True
+                    break
+                except IntegrityError:
+                    pass
+
+            if created:
+                deltas = {MARK_COUNTERS[mark_type]: 1}
+                rated = mark_type
+            elif mark.mark_type == mark_type:
+                cls.objects.filter(pk=mark.pk).delete()
+                deltas = {MARK_COUNTERS[mark_type]: -1}
+                rated = 0
+            else:
+                cls.objects.filter(pk=mark.pk).update(mark_type=mark_type, created=timezone.now())
+                deltas = {MARK_COUNTERS[mark.mark_type]: -1, MARK_COUNTERS[mark_type]: 1}
+                rated = mark_type
+
+            Post.update_counters(post.pk, **deltas)
+            PostHistory.record([post.pk], MARK_HISTORY_FIELDS[rated])
+        return rated
+
+    @classmethod
+    def rate_many(cls, user, votes):
+        """
+        Applies a sequence of (post_id, mark_type) votes with the rules of
+        rate, as if they were sent one by one, using bulk queries for the
+        marks, the counters and the history. A concurrent first vote on one
+        of the posts is caught by the (post, user) constraint like in rate,
+        and the votes are applied again over it. Returns {post_id: mark type}.
+        """
+        post_ids = {post_id for post_id, mark_type in votes}
+        with transaction.atomic():
+            Post.lock(post_ids)
+            # As in rate, the marks inserted by concurrent votes may be toggled
+            # off again before they are read, then the insert is tried again
+            while True:
+                marks = cls.locked_marks(user, post_ids)
+                rated = {post_id: mark.mark_type for post_id, mark in marks.items()}
+                for post_id, mark_type in votes:
+                    rated[post_id] = 0 if rated.get(post_id) == mark_type else mark_type
+                created = [cls(post_id=post_id, user=user, mark_type=rated[post_id])
+                           for post_id in post_ids if post_id not in marks and rated[post_id]]
+                try:
+                    with transaction.atomic():
+                        cls.objects.bulk_create(created)
+                    break
+                except IntegrityError:
+                    pass
+
+            now = timezone.now()
+            deltas = defaultdict(dict)
+            changed = defaultdict(list)
+            for post_id in post_ids:
+                old_type = marks[post_id].mark_type if post_id in marks else 0
+                new_type = rated[post_id]
+                if old_type == new_type:
+                    continue
+                if old_type:
+                    deltas[post_id][MARK_COUNTERS[old_type]] = -1
+                    changed[new_type].append(marks[post_id].pk)
+                if new_type:
+                    deltas[post_id][MARK_COUNTERS[new_type]] = 1
+
+            cls.objects.filter(pk__in=changed.pop(0, [])).delete()
+            for mark_type, mark_ids in changed.items():
+                cls.objects.filter(pk__in=mark_ids).update(mark_type=mark_type, created=now)
+
+            Post.update_counters_many(deltas)
+            for mark_type, field in MARK_HISTORY_FIELDS.items():
+                voted = [post_id for post_id in deltas if rated[post_id] == mark_type]
+                if voted:
+                    PostHistory.record(voted, field, now)
+        return rated
+
+    @classmethod
+    def locked_marks(cls, user, post_ids):
+        return {mark.post_id: mark for mark in cls.objects.select_for_update().filter(user=user, post__in=post_ids)}
 
     def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-        ph, created = PostHistory.objects.get_or_create(post=self.post)
-        ph.un_voted = timezone.now()
-        ph.save()
+        with transaction.atomic():
+            super().delete(*args, **kwargs)
+            Post.update_counters(self.post_id, **{MARK_COUNTERS[self.mark_type]: -1})
+            PostHistory.record([self.post_id], MARK_HISTORY_FIELDS[0])
 
 class Tag(models.Model):
     class Meta:
         ordering = ('weight', 'title')
 
     title = models.CharField(max_length=500)
-    alias = models.CharField(max_length=500)
+    alias = models.CharField(max_length=500, unique=True)
     weight = models.IntegerField(default=0, blank=True)
 
 
+class PostTagActivity(models.Model):
+    """
+    The post tags together with the post last_action, the (tag, last_action,
+    post) index serves a tag feed in order without sorting the whole join.
+    """
+    class Meta:
+        unique_together = (('post', 'tag'), )
+        index_together = (('tag', 'last_action', 'post'), )
+
+    post = models.ForeignKey(Post, related_name='tag_activity')
+    tag = models.ForeignKey(Tag, related_name='post_activity')
+    last_action = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def rebuild(cls, post_ids):
+        cls.objects.filter(post__in=post_ids).delete()
+        post_tags = Post.tags.through.objects.filter(post__in=post_ids)\
+            .values_list('post_id', 'tag_id', 'post__history__last_action')
+        cls.objects.bulk_create([cls(post_id=post_id, tag_id=tag_id, last_action=last_action)
+                                 for post_id, tag_id, last_action in post_tags])
+
+
 class Comment(models.Model):
     class Meta:
         ordering = ['-created']
+        index_together = (('post', 'created'), ('user', 'created'))
 
     created = models.DateTimeField(auto_now_add=True)
     post = models.ForeignKey(Post, related_name='comments')
@@ -117,10 +377,20 @@ class Comment(models.Model):
     email = models.EmailField(blank=True, null=True)
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        ph, created = PostHistory.objects.get_or_create(post=self.post)
-        ph.commented = self.created
-        ph.save()
+        with transaction.atomic():
+            adding = self._state.adding
+            super().save(*args, **kwargs)
+            if adding:
+                Post.update_counters(self.post_id, comment_count=1)
+                PostHistory.record([self.post_id], 'commented', self.created)
+            else:
+                PostHistory.touch([self.post_id])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            super().delete(*args, **kwargs)
+            Post.update_counters(self.post_id, comment_count=-1)
+            PostHistory.touch([self.post_id])
 
 
     def get_absolute_url(self):
@@ -130,15 +400,22 @@ class Comment(models.Model):
     def __str__(self):
         return self.body[:150]
 
-class CommentVersion(models.Model):
+class CommentVersion(VersionBody):
     created = models.DateTimeField(auto_now_add=True)
     comment = models.ForeignKey(Comment)
     post = models.ForeignKey(Post, related_name='comment_versions')
     user = models.ForeignKey(User, null=True, blank=True, related_name='comment_versions')
     username = models.CharField(max_length=200, blank=True)
-    body = models.TextField()
     email = models.EmailField(blank=True, null=True)
 
+    @classmethod
+    def create_for(cls, comment):
+        version = cls(comment=comment, post_id=comment.post_id, user_id=comment.user_id,
+                      username=comment.username, email=comment.email)
+        version.set_body(comment.body)
+        version.save()
+        return version
+
 
 GOOGLE = 'google'
 VK = 'vk'
@@ -150,10 +427,22 @@ SOCIAL_NETWORKS = (
     (FACEBOOK, 'facebook'),
 )
 
+COMMENTS_EMAIL_IMMEDIATE = 'immediate'
+COMMENTS_EMAIL_HOURLY = 'hourly'
+COMMENTS_EMAIL_DAILY = 'daily'
+
+COMMENTS_EMAIL_MODES = (
+    (COMMENTS_EMAIL_IMMEDIATE, 'immediate'),
+    (COMMENTS_EMAIL_HOURLY, 'hourly'),
+    (COMMENTS_EMAIL_DAILY, 'daily'),
+)
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, related_name='user_profile')
     receive_comments_email = models.BooleanField(default=True)
     email_confirmed = models.BooleanField(default=False)
+    comments_email_mode = models.CharField(choices=COMMENTS_EMAIL_MODES, max_length=20,
+                                           default=COMMENTS_EMAIL_IMMEDIATE)
     #activation_token = models.TextField(null=True, blank=True)
 
     #def save(self, *args, **kwargs):
@@ -166,8 +455,18 @@ class UserProfile(models.Model):
     def __str__(self):
         return self.user.username
 
+    def get_next_digest_time(self):
+        now = timezone.localtime(timezone.now())
+        if self.comments_email_mode == COMMENTS_EMAIL_HOURLY:
+            return now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        else:
+            return now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
 
 class SocialAccount(models.Model):
+    class Meta:
+        unique_together = (('network', 'external_id'), )
+
     user = models.ForeignKey(User, related_name='social_accounts')
     external_id = models.CharField(max_length=500, null=True, blank=True)
     network = models.CharField(choices=SOCIAL_NETWORKS, max_length=20)
@@ -176,10 +475,281 @@ class SocialAccount(models.Model):
     def __str__(self):
         return "{} - {}".format(self.user.username, self.network)
 
+
+def create_user_with_free_username(username, attempts=10, **fields):
+    """
+    Creates a user named username or, when that is taken, username followed
+    by a number above all the taken ones, e.g. "Ivan Ivanov3". The taken
+    names are read with one prefix query on the username index and a
+    concurrent signup taking the same name makes it try again.
+    """
+    max_length = User._meta.get_field('username').max_length
+    base = username[:max_length]
+    shortened = False
+    for attempt in range(attempts):
+        pattern = '^{}([1-9][0-9]*)?$'.format(re.sub(r'([\\.^$|?*+()\[\]{}])', r'\\\1', base))
+        taken = User.objects.filter(username__startswith=base, username__regex=pattern)\
+            .values_list('username', flat=True)
+        numbers = [int(name[len(base):] or 0) for name in taken]
+        if shortened:
+            # A cut name always gets a number
+            numbers.append(0)
+        candidate = base
+        if 0 in numbers:
+            suffix = str(max(numbers) + 1)
+            if len(base) + len(suffix) > max_length:
+                # A shorter base has its own numbers, look them up again
+                base = base[:max_length - len(suffix)]
+                shortened = True
+                continue
+            candidate = base + suffix
+        try:
+            with transaction.atomic():
+                return User.objects.create(username=candidate, **fields)
+        except IntegrityError:
+            continue
+    raise IntegrityError('Unable to find a free username for {}'.format(username))
+
+
+class RevokedToken(models.Model):
+    """
+    Digests of the deleted API tokens, they are refused by the processes
+    which may still have them cached, see CachedTokenAuthentication.
+    """
+    digest = models.CharField(max_length=64)
+    revoked = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+EMAIL_PENDING = 1
+EMAIL_SENT = 2
+EMAIL_FAILED = 3
+
+EMAIL_STATUSES = (
+    (EMAIL_PENDING, 'Pending'),
+    (EMAIL_SENT, 'Sent'),
+    (EMAIL_FAILED, 'Failed'),
+)
+
+
+def dump_email_context(context):
+    """
+    Model instances are stored as references and loaded again when the email
+    is rendered, the rest of the context must be JSON serializable.
+    """
+    dumped = {}
+    for key, value in context.items():
+        if isinstance(value, models.Model):
+            value = {'__model__': value._meta.label_lower, 'pk': value.pk}
+        dumped[key] = value
+    return json.dumps(dumped)
+
+
+def load_email_context(context, exclude=()):
+    loaded = {}
+    for key, value in json.loads(context).items():
+        if key in exclude:
+            continue
+        if isinstance(value, dict) and '__model__' in value:
+            value = apps.get_model(value['__model__']).objects.get(pk=value['pk'])
+        loaded[key] = value
+    return loaded
+
+
+class OutgoingEmail(models.Model):
+    class Meta:
+        index_together = (('status', 'send_after'), )
+
+    created = models.DateTimeField(auto_now_add=True)
+    to_email = models.EmailField()
+    from_email = models.CharField(max_length=254, blank=True)
+    subject_template_name = models.CharField(max_length=200)
+    plain_body_template_name = models.CharField(max_length=200, blank=True)
+    html_body_template_name = models.CharField(max_length=200, blank=True)
+    context = models.TextField()
+    status = models.PositiveIntegerField(choices=EMAIL_STATUSES, default=EMAIL_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    send_after = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # Pending emails sharing a digest are sent as one message listing their comments
+    digest = models.CharField(max_length=100, blank=True, db_index=True)
+
+    def __str__(self):
+        return "{} - {}".format(self.to_email, self.subject_template_name)
+
+    @classmethod
+    def enqueue(cls, to_email, from_email, context, subject_template_name,
+                plain_body_template_name=None, html_body_template_name=None, send_after=None, digest=''):
+        return cls.objects.create(
+            to_email=to_email,
+            from_email=from_email or '',
+            context=dump_email_context(context),
+            subject_template_name=subject_template_name,
+            plain_body_template_name=plain_body_template_name or '',
+            html_body_template_name=html_body_template_name or '',
+            send_after=send_after or timezone.now(),
+            digest=digest,
+        )
+
+    def render(self, digested=()):
+        """
+        Renders the email. For a digest, `digested` holds all of its emails,
+        each with one `comment` in the context, and the template receives
+        them all as `comments`. The comments deleted since are left out,
+        and a digest with none left renders to None.
+        """
+        if digested:
+            context = load_email_context(self.context, exclude=('comment', ))
+            comment_ids = [json.loads(email.context)['comment']['pk'] for email in digested]
+            context['comments'] = list(Comment.objects.filter(pk__in=comment_ids).select_related('post')
+                                       .order_by('id'))
+            if not context['comments']:
+                return None
+        else:
+            context = load_email_context(self.context)
+
+        # Same message layout as djoser.utils.send_email
+        subject = loader.render_to_string(self.subject_template_name, context)
+        subject = ''.join(subject.splitlines())
+        from_email = self.from_email or None
+
+        if self.plain_body_template_name:
+            plain_body = loader.render_to_string(self.plain_body_template_name, context)
+            message = EmailMultiAlternatives(subject, plain_body, from_email, [self.to_email])
+            if self.html_body_template_name:
+                html_body = loader.render_to_string(self.html_body_template_name, context)
+                message.attach_alternative(html_body, 'text/html')
+        else:
+            html_body = loader.render_to_string(self.html_body_template_name, context)
+            message = EmailMessage(subject, html_body, from_email, [self.to_email])
+            message.content_subtype = 'html'
+        return message
+
+    @classmethod
+    def claim_pending(cls, batch_size=100, lease=timedelta(minutes=10)):
+        """
+        Claims a batch of due emails in a short transaction by moving their
+        send_after past the lease, so that other senders skip them while they
+        are sent outside of it. Emails left by a sender that died are due
+        again once the lease runs out. Returns (email, digested) pairs, see
+        render().
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            emails = list(cls.objects.select_for_update().filter(
+                status=EMAIL_PENDING, send_after__lte=now).order_by('send_after', 'id')[:batch_size])
+            digests = {}
+            if any(email.digest for email in emails):
+                for email in cls.objects.select_for_update().filter(
+                        status=EMAIL_PENDING, send_after__lte=now,
+                        digest__in={email.digest for email in emails if email.digest}).order_by('id'):
+                    digests.setdefault(email.digest, []).append(email)
+
+            claimed, seen = [], set()
+            for email in emails:
+                if email.pk in seen:
+                    continue
+                digested = digests.get(email.digest, ()) if email.digest else ()
+                seen.update(digested_email.pk for digested_email in digested)
+                claimed.append((email, digested))
+            if claimed:
+                cls.objects.filter(pk__in=seen | {email.pk for email, digested in claimed})\
+                    .update(send_after=now + lease)
+        return claimed
+
+    @classmethod
+    def send_pending(cls, batch_size=100, max_attempts=5):
+        """
+        Sends a batch of due emails over one connection. A failed email is
+        retried with an exponential backoff until max_attempts is reached.
+        Returns the number of sent and failed emails.
+        """
+        sent = failed = 0
+        claimed = cls.claim_pending(batch_size)
+        if not claimed:
+            return sent, failed
+
+        # No transaction is open while the SMTP server is talked to
+        with get_connection() as connection:
+            for email, digested in claimed:
+                email.attempts += 1
+                emails = cls.objects.filter(pk__in=[email.pk] + [digested_email.pk for digested_email in digested])
+                try:
+                    message = email.render(digested)
+                    if message is not None:
+                        message.connection = connection
+                        message.send()
+                except Exception as e:
+                    if email.attempts >= max_attempts:
+                        emails.update(status=EMAIL_FAILED, attempts=email.attempts, last_error=str(e))
+                    else:
+                        emails.update(send_after=timezone.now() + timedelta(minutes=2 ** email.attempts),
+                                      attempts=email.attempts, last_error=str(e))
+                    failed += 1
+                else:
+                    if message is None:
+                        emails.update(status=EMAIL_FAILED, attempts=email.attempts,
+                                      last_error='All the comments of the digest were deleted')
+                        failed += 1
+                    else:
+                        emails.update(status=EMAIL_SENT, sent=timezone.now(), attempts=email.attempts)
+                        sent += 1
+        return sent, failed
+
+
 def create_user_profile(sender, instance, created, **kwargs):
-    profile, created = UserProfile.objects.get_or_create(user=instance)
     if created:
-        profile.save()
+        UserProfile.objects.create(user=instance)
+
+
+post_save.connect(create_user_profile, sender=User)
+
+
+def update_post_tag_activity(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        PostTagActivity.rebuild([instance.pk])
+    elif action == 'post_clear':
+        PostTagActivity.objects.filter(tag=instance).delete()
+    else:
+        PostTagActivity.rebuild(pk_set)
+
+
+m2m_changed.connect(update_post_tag_activity, sender=Post.tags.through)
+
+
+def invalidate_tags(sender, **kwargs):
+    bump_generation('tags')
+
+
+post_save.connect(invalidate_tags, sender=Tag)
+post_delete.connect(invalidate_tags, sender=Tag)
+
+
+def invalidate_posts(sender, **kwargs):
+    bump_generation('posts')
+
+
+post_save.connect(invalidate_posts, sender=Post)
+post_delete.connect(invalidate_posts, sender=Post)
+
+
+def invalidate_token(sender, instance, **kwargs):
+    CachedTokenAuthentication.invalidate([instance.key])
+    # An expired token is refused anyway
+    if not is_token_expired(instance):
+        RevokedToken.objects.create(digest=get_token_digest(instance.key))
+
+
+def invalidate_user_tokens(sender, instance, created, update_fields, **kwargs):
+    # A new user has no token yet and a login only stamps last_login
+    if created or update_fields == frozenset(['last_login']):
+        return
+    user_id = instance.user_id if sender is UserProfile else instance.pk
+    CachedTokenAuthentication.invalidate(Token.objects.filter(user=user_id).values_list('key', flat=True))
 
 
-post_save.connect(create_user_profile, sender=User)
\ No newline at end of file
+post_delete.connect(invalidate_token, sender=Token)
+post_save.connect(invalidate_user_tokens, sender=User)
+post_save.connect(invalidate_user_tokens, sender=UserProfile)
@@ -1,5 +1,135 @@
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
 
 class UnlimitedPagination(LimitOffsetPagination):
     default_limit = 100
     max_limit = 100
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination which switches to keyset pagination when the
+    `cursor` query parameter is present (an empty cursor is the first page):
+
+    http://api.example.org/posts/?cursor=
+    http://api.example.org/posts/?cursor=WyIyMDE2LTA2LTI0IiwgMTBd&limit=20
+
+    The view's `get_keyset_ordering()` returns a tuple of fields or
+    annotations ending with a unique one, e.g. ('-last_action', '-id').
+    A view with a true `keyset_only` is always paginated by keyset. Values
+    after the position in a cursor are kept in `cursor_extra` for the view.
+    Each page is fetched with a range condition on these fields instead of
+    an offset, so it costs the same however deep it is and does not skip
+    or repeat rows when the ordering changes between requests.
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = _('Invalid cursor')
+
+    keyset = False
+    cursor_extra = ()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and not getattr(view, 'keyset_only', False):
+            return super().paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.keyset = True
+        self.request = request
+        self.ordering = self.get_keyset_ordering(view)
+
+        queryset = queryset.order_by(*self.ordering)
+        self.start_position = position = self.decode_cursor(request, queryset)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(position))
+
+        results = list(queryset[:self.limit + 1])
+        self.has_next = len(results) > self.limit
+        results = results[:self.limit]
+        self.position = self.get_position(results[-1]) if results else position
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.position))
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        return None
+
+    def get_keyset_ordering(self, view):
+        return tuple(view.get_keyset_ordering())
+
+    def get_keyset_filter(self, position):
+        """
+        (a, b) after (A, B) for descending fields is
+        a <= A AND (a < A OR (a = A AND b < B)), the first condition lets the
+        database walk the index range instead of evaluating the disjunction
+        for every row.
+        """
+        condition = Q()
+        equal = {}
+        for order, value in zip(self.ordering, position):
+            name = order.lstrip('-')
+            lookup = 'lt' if order.startswith('-') else 'gt'
+            condition |= Q(**dict(equal, **{'{}__{}'.format(name, lookup): value}))
+            equal[name] = value
+
+        first = self.ordering[0]
+        lookup = 'lte' if first.startswith('-') else 'gte'
+        return Q(**{'{}__{}'.format(first.lstrip('-'), lookup): position[0]}) & condition
+
+    def get_position(self, instance):
+        return [getattr(instance, order.lstrip('-')) for order in self.ordering]
+
+    def encode_cursor(self, position):
+        position = json.dumps([str(value) for value in position])
+        return b64encode(position.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            position = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+            if not isinstance(position, list) or len(position) < len(self.ordering):
+                raise ValueError
+            self.cursor_extra = position[len(self.ordering):]
+            return [self._get_field(queryset, order.lstrip('-')).to_python(value)
+                    for order, value in zip(self.ordering, position)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def _get_field(self, queryset, name):
+        annotation = queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return queryset.model._meta.get_field(name)
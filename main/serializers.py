@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from main.models import Post, PostMark, Tag, Comment, UserProfile
+from main.models import Post, PostMark, Tag, Comment, UserProfile, COMMENTS_EMAIL_MODES, POST_MARKS
 from django.contrib.auth.models import User
 from djoser import settings as djoser_settings
 from djoser import serializers as djoser_serializers
@@ -38,7 +38,21 @@ class UsernameMixin:
             raise serializers.ValidationError(_("This field cannot be blank."))
 
 
-class CommentSerializer(UsernameMixin, serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """
+    Renders only the fields listed in the `fields` context value and drops
+    the ones listed in `exclude`.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        exclude = self.context.get('exclude') or ()
+        for name in list(self.fields):
+            if fields is not None and name not in fields or name in exclude:
+                self.fields.pop(name)
+
+
+class CommentSerializer(SparseFieldsMixin, UsernameMixin, serializers.ModelSerializer):
     created = DateTimeFielTZ(format="%d.%m.%Y %H:%M:%S", required=False, read_only=True)
 
     class Meta:
@@ -49,19 +63,31 @@ class CommentSerializer(UsernameMixin, serializers.ModelSerializer):
 
 
 
-class PostSerializer(UsernameMixin, serializers.ModelSerializer):
+class PostSerializer(SparseFieldsMixin, UsernameMixin, serializers.ModelSerializer):
+    max_comments_limit = 100
+
     rated = serializers.IntegerField(required=False)
-    comments = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    comments = serializers.SerializerMethodField()
     created = DateTimeFielTZ(format="%d.%m.%Y %H:%M:%S", required=False, read_only=True)
     body = serializers.CharField(required=True, min_length=300)
 
     class Meta:
         model = Post
         fields = ('id', 'user', 'username', 'body', 'rated', 'created', 'tags', 'comment_count', 'comments', 'email', 'liked_count', 'disliked_count')
+        read_only_fields = ('comment_count', 'liked_count', 'disliked_count')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.comments_limit = self.context.get('comments_limit', self.max_comments_limit)
+        if not self.comments_limit:
+            self.fields.pop('comments', None)
+
+    def get_comments(self, post):
+        return [comment.pk for comment in post.comments.all()[:self.comments_limit]]
 
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     #posts = serializers.PrimaryKeyRelatedField(many=True, queryset=Post.objects.all())
 
     class Meta:
@@ -69,13 +95,18 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'posts', 'comments')
 
 
-class PostMarkSerializer(serializers.ModelSerializer):
+class PostMarkSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = PostMark
         fields = ('id', 'post', 'mark_type', 'user')
 
 
-class TagSerializer(serializers.ModelSerializer):
+class VoteSerializer(serializers.Serializer):
+    post = serializers.IntegerField()
+    rated = serializers.ChoiceField(choices=POST_MARKS)
+
+
+class TagSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = ('id', 'title', 'alias')
@@ -123,13 +154,15 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UserProfile
-        fields = ('id', 'receive_comments_email', 'email_confirmed')
+        fields = ('id', 'receive_comments_email', 'email_confirmed', 'comments_email_mode')
 
 
 class UserSerializerWithToken(UserSerializer):
     # auth_token = serializers.PrimaryKeyRelatedField(many=True, queryset=Post.objects.all())
     receive_comments_email = serializers.BooleanField(source='user_profile.receive_comments_email')
     email_confirmed = serializers.BooleanField(source='user_profile.email_confirmed')
+    comments_email_mode = serializers.ChoiceField(source='user_profile.comments_email_mode',
+                                                  choices=COMMENTS_EMAIL_MODES)
 
     class Meta:
         model = User
@@ -139,6 +172,7 @@ class UserSerializerWithToken(UserSerializer):
             'auth_token',
             'receive_comments_email',
             'email_confirmed',
+            'comments_email_mode',
             'email'
         )
         read_only_fields = (
@@ -1,3 +1,722 @@
-from django.test import TestCase
+import threading
+from io import StringIO
+from datetime import timedelta
+from unittest.mock import patch
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import connection, IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from .authentication import CachedTokenAuthentication, get_valid_token
+from .models import Post, PostHistory, PostMark, PostVersion, Comment, CommentVersion, Tag, OutgoingEmail, \
+    RevokedToken, SocialAccount, POST_MARK_LIKE, POST_MARK_DISLIKE, COMMENTS_EMAIL_HOURLY, EMAIL_PENDING, \
+    EMAIL_SENT, EMAIL_FAILED, create_user_with_free_username
+from .views import PostViewSet, SocialLogin
 
-# Create your tests here.
+
+class PostChangesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.client = APIClient()
+
+    def create_post(self):
+        return Post.objects.create(user=self.user, username=self.user.username, body='body')
+
+    def create_comment(self, post):
+        return Comment.objects.create(post=post, user=self.user, username=self.user.username, body='comment')
+
+    def test_pages_keep_the_comments_since(self):
+        post_a, post_b = self.create_post(), self.create_post()
+        since = timezone.now().isoformat()
+        c1 = self.create_comment(post_b)
+        c2 = self.create_comment(post_a)
+        c3 = self.create_comment(post_b)
+
+        response = self.client.get('/api/v1/posts/changes/', {'since': since, 'limit': 1})
+        self.assertEqual([post['id'] for post in response.data['posts']], [post_a.pk])
+        self.assertEqual([comment['id'] for comment in response.data['comments']], [c2.pk])
+        self.assertTrue(response.data['more'])
+
+        response = self.client.get('/api/v1/posts/changes/', {'cursor': response.data['cursor'], 'limit': 1})
+        self.assertEqual([post['id'] for post in response.data['posts']], [post_b.pk])
+        self.assertEqual([comment['id'] for comment in response.data['comments']], [c1.pk, c3.pk])
+        self.assertFalse(response.data['more'])
+
+        # The next poll returns the changes of the overlap again
+        c4 = self.create_comment(post_a)
+        response = self.client.get('/api/v1/posts/changes/', {'cursor': response.data['cursor']})
+        self.assertEqual([post['id'] for post in response.data['posts']], [post_b.pk, post_a.pk])
+        self.assertEqual([comment['id'] for comment in response.data['comments']], [c1.pk, c2.pk, c3.pk, c4.pk])
+
+    def test_overlap(self):
+        post = self.create_post()
+        since = timezone.now().isoformat()
+        self.create_comment(post)
+        response = self.client.get('/api/v1/posts/changes/', {'since': since})
+        post.history.changed = timezone.now() - PostViewSet.changes_overlap - timedelta(seconds=1)
+        post.history.save()
+        cursor = response.data['cursor']
+        response = self.client.get('/api/v1/posts/changes/', {'cursor': cursor})
+        self.assertEqual(response.data['posts'], [])
+        # An empty poll does not move further back
+        self.assertEqual(response.data['cursor'], cursor)
+
+    def test_fields(self):
+        post = self.create_post()
+        since = timezone.now().isoformat()
+        comment = self.create_comment(post)
+        response = self.client.get('/api/v1/posts/changes/', {'since': since, 'fields': 'id,tags'})
+        self.assertEqual(list(response.data['posts'][0]), ['id', 'tags'])
+        self.assertEqual(response.data['comments'][0]['body'], comment.body)
+
+    def test_late_commit(self):
+        post_a, post_b = self.create_post(), self.create_post()
+        since = timezone.now().isoformat()
+        c1 = self.create_comment(post_a)
+        response = self.client.get('/api/v1/posts/changes/', {'since': since})
+        self.assertEqual([post['id'] for post in response.data['posts']], [post_a.pk])
+
+        # Stamped before c1 but committed after the poll
+        late = self.create_comment(post_b)
+        stamped = c1.created - timedelta(microseconds=1)
+        Comment.objects.filter(pk=late.pk).update(created=stamped)
+        PostHistory.objects.filter(post=post_b).update(changed=stamped)
+
+        response = self.client.get('/api/v1/posts/changes/', {'cursor': response.data['cursor']})
+        self.assertEqual([post['id'] for post in response.data['posts']], [post_b.pk, post_a.pk])
+        self.assertEqual([comment['id'] for comment in response.data['comments']], [late.pk, c1.pk])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/posts/changes/', {'cursor': 'bad'})
+        self.assertEqual(response.status_code, 404)
+
+
+class PostListQueriesTest(TestCase):
+    """
+    A page of posts makes the same number of queries however many posts,
+    tags and comments it shows.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        tags = [Tag.objects.create(title=str(i), alias=str(i)) for i in range(3)]
+        self.since = timezone.now()
+        for i in range(12):
+            post = Post.objects.create(user=self.user, username=self.user.username, body='body')
+            post.tags.add(*tags)
+            for j in range(3):
+                Comment.objects.create(post=post, user=self.user, username=self.user.username, body='comment')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertPageQueries(self, num, **params):
+        # The validators of the conditional GET, the count, the posts and the prefetches
+        with self.assertNumQueries(num):
+            response = self.client.get('/api/v1/posts/', dict(params, limit=10))
+        self.assertEqual(len(response.data['results']), 10)
+        return response
+
+    def test_list(self):
+        response = self.assertPageQueries(4)
+        self.assertEqual(len(response.data['results'][0]['tags']), 3)
+        self.assertNotIn('comments', response.data['results'][0])
+
+    def test_comments_limit(self):
+        response = self.assertPageQueries(5, comments_limit=2)
+        self.assertEqual(len(response.data['results'][0]['comments']), 2)
+
+    def test_fields(self):
+        response = self.assertPageQueries(3, fields='id,body')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'body'})
+        response = self.assertPageQueries(5, fields='id,tags,comments')
+        self.assertEqual(len(response.data['results'][0]['comments']), 3)
+
+    def test_keyset(self):
+        self.assertPageQueries(3, cursor='')
+
+    def test_changes(self):
+        # The posts, the tags and the comments
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/posts/changes/', {'since': self.since.isoformat(), 'limit': 10})
+        self.assertEqual(len(response.data['posts']), 10)
+        self.assertEqual(len(response.data['posts'][0]['tags']), 3)
+        self.assertEqual(len(response.data['comments']), 30)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PostSearchTest(TestCase):
+    def setUp(self):
+        # The generations are bumped on commit, never in a TestCase
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.posts = [Post.objects.create(user=self.user, username=self.user.username, body=body)
+                      for body in ('red apple', 'green apple', 'red pear', 'apple pie with red', 'Red apples')]
+        self.client = APIClient()
+
+    def get_ids(self, response):
+        return [post['id'] for post in response.data['results']]
+
+    def test_search(self):
+        response = self.client.get('/api/v1/posts/', {'search': 'red apple'})
+        if connection.vendor == 'postgresql':
+            # ts_rank puts the words found next to each other first
+            expected = [self.posts[4], self.posts[0], self.posts[3]]
+        else:
+            expected = [self.posts[4], self.posts[3], self.posts[0]]
+        self.assertEqual(self.get_ids(response), [post.pk for post in expected])
+
+    def test_cursor(self):
+        response = self.client.get('/api/v1/posts/', {'search': 'apple', 'cursor': '', 'limit': 2})
+        self.assertEqual(self.get_ids(response), [self.posts[4].pk, self.posts[3].pk])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.get_ids(response), [self.posts[1].pk, self.posts[0].pk])
+        self.assertIsNone(response.data['next'])
+
+    def test_cursor_ranked(self):
+        expected = self.get_ids(self.client.get('/api/v1/posts/', {'search': 'red apple'}))
+        ids = []
+        url, params = '/api/v1/posts/', {'search': 'red apple', 'cursor': '', 'limit': 1}
+        while url:
+            response = self.client.get(url, params)
+            ids += self.get_ids(response)
+            url, params = response.data['next'], {}
+        self.assertEqual(ids, expected)
+
+
+class PostCountersTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author')
+        self.user = User.objects.create_user('user')
+        self.post = Post.objects.create(user=self.author, username=self.author.username, body='body')
+
+    def get_counters(self):
+        post = Post.objects.get(pk=self.post.pk)
+        return post.comment_count, post.liked_count, post.disliked_count
+
+    def test_comments(self):
+        comment = Comment.objects.create(post=self.post, user=self.user, username=self.user.username, body='comment')
+        Comment.objects.create(post=self.post, user=self.user, username=self.user.username, body='comment')
+        comment.body = 'edited'
+        comment.save()
+        self.assertEqual(self.get_counters(), (2, 0, 0))
+        comment.delete()
+        self.assertEqual(self.get_counters(), (1, 0, 0))
+
+    def test_marks(self):
+        PostMark(post=self.post, user=self.user, mark_type=POST_MARK_LIKE).save()
+        self.assertEqual(self.get_counters(), (0, 1, 0))
+        # A new mark of the same user replaces the previous one
+        mark = PostMark(post=self.post, user=self.user, mark_type=POST_MARK_DISLIKE)
+        mark.save()
+        self.assertEqual(self.get_counters(), (0, 0, 1))
+        mark.delete()
+        self.assertEqual(self.get_counters(), (0, 0, 0))
+        # The author's own mark is not stored
+        PostMark(post=self.post, user=self.author, mark_type=POST_MARK_LIKE).save()
+        self.assertEqual(self.get_counters(), (0, 0, 0))
+
+    def test_post_save(self):
+        stale = Post.objects.get(pk=self.post.pk)
+        Comment.objects.create(post=self.post, user=self.user, username=self.user.username, body='comment')
+        PostMark.rate(self.post, self.user, POST_MARK_LIKE)
+        stale.body = 'edited'
+        stale.save()
+        self.assertEqual(self.get_counters(), (1, 1, 0))
+        self.assertEqual(Post.objects.get(pk=self.post.pk).body, 'edited')
+
+    def test_rebuild(self):
+        Comment.objects.create(post=self.post, user=self.user, username=self.user.username, body='comment')
+        PostMark.rate(self.post, self.user, POST_MARK_DISLIKE)
+        Post.objects.create(user=self.author, username=self.author.username, body='body')
+        Post.objects.filter(pk=self.post.pk).update(comment_count=5, liked_count=2, disliked_count=0)
+
+        out = StringIO()
+        call_command('rebuild_post_counters', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Counters fixed for 1 posts')
+        self.assertEqual(self.get_counters(), (1, 0, 1))
+
+
+class RateBatchTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author')
+        self.user = User.objects.create_user('user')
+        self.posts = [Post.objects.create(user=self.author, username=self.author.username, body='body')
+                      for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def rate_batch(self, votes):
+        return self.client.post('/api/v1/posts/rate_batch/', [{'post': post.pk, 'rated': mark_type}
+                                                              for post, mark_type in votes], format='json')
+
+    def get_counters(self, post):
+        post.refresh_from_db()
+        return post.liked_count, post.disliked_count
+
+    def test_sequence(self):
+        first, second, third = self.posts
+        PostMark.rate(third, self.user, POST_MARK_LIKE)
+        response = self.rate_batch([(first, POST_MARK_LIKE), (second, POST_MARK_LIKE), (first, POST_MARK_LIKE),
+                                    (second, POST_MARK_DISLIKE), (third, POST_MARK_LIKE)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [
+            {'id': first.pk, 'liked_count': 0, 'disliked_count': 0, 'rated': 0},
+            {'id': second.pk, 'liked_count': 0, 'disliked_count': 1, 'rated': POST_MARK_DISLIKE},
+            {'id': third.pk, 'liked_count': 0, 'disliked_count': 0, 'rated': 0},
+        ])
+        self.assertEqual(dict(PostMark.objects.values_list('post', 'mark_type')), {second.pk: POST_MARK_DISLIKE})
+        self.assertEqual([self.get_counters(post) for post in self.posts], [(0, 0), (0, 1), (0, 0)])
+
+    def test_change(self):
+        PostMark.rate(self.posts[0], self.user, POST_MARK_LIKE)
+        response = self.rate_batch([(self.posts[0], POST_MARK_DISLIKE)])
+        self.assertEqual(response.data[0]['rated'], POST_MARK_DISLIKE)
+        self.assertEqual(self.get_counters(self.posts[0]), (0, 1))
+
+    def test_concurrent_first_vote(self):
+        post = self.posts[0]
+        locked_marks = PostMark.locked_marks
+        calls = []
+
+        def concurrent_vote(user, post_ids):
+            marks = locked_marks(user, post_ids)
+            if not calls:
+                # Committed by another request after the marks were read
+                PostMark.rate(post, user, POST_MARK_LIKE)
+            calls.append(marks)
+            return marks
+
+        with patch.object(PostMark, 'locked_marks', concurrent_vote):
+            rated = PostMark.rate_many(self.user, [(post.pk, POST_MARK_LIKE)])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(rated, {post.pk: 0})
+        self.assertFalse(PostMark.objects.exists())
+        self.assertEqual(self.get_counters(post), (0, 0))
+
+    def test_invalid(self):
+        self.assertEqual(self.rate_batch([(self.posts[0], 3)]).status_code, 400)
+        response = self.client.post('/api/v1/posts/rate_batch/', [{'post': 0, 'rated': POST_MARK_LIKE}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.rate_batch([(self.posts[0], POST_MARK_LIKE)] * 101).status_code, 400)
+        self.assertFalse(PostMark.objects.exists())
+
+    def test_own_post(self):
+        own = Post.objects.create(user=self.user, username=self.user.username, body='body')
+        response = self.rate_batch([(self.posts[0], POST_MARK_LIKE), (own, POST_MARK_LIKE)])
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(PostMark.objects.exists())
+
+    def test_anonymous(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.rate_batch([(self.posts[0], POST_MARK_LIKE)]).status_code, 401)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentRateTest(TransactionTestCase):
+    def test_parallel_votes(self):
+        author = User.objects.create_user('author')
+        post = Post.objects.create(user=author, username=author.username, body='body')
+        voters = [User.objects.create_user('voter{}'.format(i)) for i in range(4)]
+        errors = []
+
+        def vote(user, mark_types):
+            try:
+                for mark_type in mark_types:
+                    PostMark.rate(post, user, mark_type)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        # Several threads per voter race on the same (post, user) mark
+        threads = [threading.Thread(target=vote, args=(voter, [1, 2, 1, 1, 2, 2]))
+                   for voter in voters for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assert_counters(post)
+
+    def test_parallel_batches(self):
+        author = User.objects.create_user('author')
+        posts = [Post.objects.create(user=author, username=author.username, body='body') for i in range(2)]
+        voters = [User.objects.create_user('voter{}'.format(i)) for i in range(3)]
+        errors = []
+
+        def vote(user, batch):
+            try:
+                for mark_type in [1, 2, 1, 1, 2, 2]:
+                    if batch:
+                        PostMark.rate_many(user, [(post.pk, mark_type) for post in posts])
+                    else:
+                        PostMark.rate(posts[0], user, mark_type)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        # Batches race with each other and with single votes on the same marks
+        threads = [threading.Thread(target=vote, args=(voter, batch))
+                   for voter in voters for batch in (True, True, False)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for post in posts:
+            self.assert_counters(post)
+
+    def assert_counters(self, post):
+        marks = PostMark.objects.filter(post=post)
+        self.assertEqual(marks.order_by().values('user').distinct().count(), marks.count())
+        post.refresh_from_db()
+        self.assertEqual(post.liked_count, marks.filter(mark_type=1).count())
+        self.assertEqual(post.disliked_count, marks.filter(mark_type=2).count())
+
+
+class FreeUsernameTest(TestCase):
+    def test_thousands_of_collisions(self):
+        name = 'Иван Иванов'
+        User.objects.bulk_create([User(username=name)] +
+                                 [User(username='{}{}'.format(name, i)) for i in range(1, 3000)] +
+                                 [User(username=name + ' Петров'), User(username=name + '01')])
+        # The prefix query, the user and its profile inserts in a savepoint
+        with self.assertNumQueries(5):
+            user = create_user_with_free_username(name)
+        self.assertEqual(user.username, name + '3000')
+        self.assertEqual(create_user_with_free_username(name).username, name + '3001')
+
+    def test_free_name(self):
+        User.objects.create(username='name1')
+        self.assertEqual(create_user_with_free_username('name').username, 'name')
+
+    def test_regex_characters(self):
+        for name in ('a.b*c', '(x)+[y]{2}', 'a|b$^\\'):
+            self.assertEqual(create_user_with_free_username(name).username, name)
+            self.assertEqual(create_user_with_free_username(name).username, name + '1')
+        User.objects.create(username='aXb*c5')
+        self.assertEqual(create_user_with_free_username('a.b*c').username, 'a.b*c2')
+
+    def test_max_length(self):
+        max_length = User._meta.get_field('username').max_length
+        name = 'x' * (max_length + 5)
+        self.assertEqual(create_user_with_free_username(name).username, 'x' * max_length)
+        usernames = [create_user_with_free_username(name).username for i in range(11)]
+        self.assertEqual(usernames[:9], ['x' * (max_length - 1) + str(i) for i in range(1, 10)])
+        self.assertEqual(usernames[9:], ['x' * (max_length - 2) + str(i) for i in range(1, 3)])
+        self.assertTrue(all(len(username) <= max_length for username in usernames))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AnonymousCacheTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.post = Post.objects.create(user=self.user, username=self.user.username, body='body')
+        self.client = APIClient()
+
+    def get_post(self, field):
+        list_value = self.client.get('/api/v1/posts/').data['results'][0][field]
+        detail_value = self.client.get('/api/v1/posts/{}/'.format(self.post.pk)).data[field]
+        self.assertEqual(list_value, detail_value)
+        return detail_value
+
+    def test_cached(self):
+        self.assertEqual(self.get_post('body'), 'body')
+        Post.objects.filter(pk=self.post.pk).update(body='changed')
+        self.assertEqual(self.get_post('body'), 'body')
+
+    def test_invalidated_by_comment(self):
+        self.assertEqual(self.get_post('comment_count'), 0)
+        Comment.objects.create(post=self.post, user=self.user, username=self.user.username, body='comment')
+        self.assertEqual(self.get_post('comment_count'), 1)
+
+    def test_invalidated_by_vote(self):
+        self.assertEqual(self.get_post('liked_count'), 0)
+        PostMark.rate(self.post, self.user, POST_MARK_LIKE)
+        self.assertEqual(self.get_post('liked_count'), 1)
+
+    def test_invalidated_by_post_save(self):
+        self.get_post('body')
+        self.post.body = 'changed'
+        self.post.save()
+        self.assertEqual(self.get_post('body'), 'changed')
+
+
+@override_settings(COMPRESS_VERSION_BODY=True)
+class VersionAdminTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+
+    def test_compressed_body(self):
+        post = Post.objects.create(user=self.user, username=self.user.username, body='compressed ' * 20)
+        version = PostVersion.create_for(post)
+        comment = Comment.objects.create(post=post, user=self.user, username=self.user.username, body='comment ' * 20)
+        comment_version = CommentVersion.create_for(comment)
+        self.assertEqual((version.body, comment_version.body), ('', ''))
+
+        response = self.client.get('/admin/main/postversion/{}/change/'.format(version.pk))
+        self.assertContains(response, 'compressed ' * 20)
+        response = self.client.get('/admin/main/commentversion/{}/change/'.format(comment_version.pk))
+        self.assertContains(response, 'comment ' * 20)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalGetTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_post(self):
+        return Post.objects.create(user=self.user, username=self.user.username, body='body')
+
+    def test_not_modified(self):
+        self.create_post()
+        etag = self.client.get('/api/v1/posts/')['ETag']
+        response = self.client.get('/api/v1/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.create_post()
+        response = self.client.get('/api/v1/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_post(self):
+        old_post = self.create_post()
+        self.create_post()
+        etag = self.client.get('/api/v1/posts/')['ETag']
+
+        old_post.delete()
+        response = self.client.get('/api/v1/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_late_commit(self):
+        old_post, new_post = self.create_post(), self.create_post()
+        etag = self.client.get('/api/v1/posts/')['ETag']
+
+        # Stamped before the latest change but committed after the request
+        Comment.objects.create(post=old_post, user=self.user, username=self.user.username, body='comment')
+        PostHistory.objects.filter(post=old_post).update(changed=new_post.history.changed - timedelta(seconds=1))
+        response = self.client.get('/api/v1/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+
+    def test_detail_not_modified_since(self):
+        post = self.create_post()
+        last_modified = self.client.get('/api/v1/posts/{}/'.format(post.pk))['Last-Modified']
+        response = self.client.get('/api/v1/posts/{}/'.format(post.pk), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TokenAuthenticationTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        revoked_tokens = CachedTokenAuthentication.revoked_tokens
+        revoked_tokens.digests, revoked_tokens.refreshed, revoked_tokens.refreshed_at = {}, None, 0
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token {}'.format(self.token.key))
+
+    def set_created(self, created):
+        Token.objects.filter(pk=self.token.pk).update(created=created)
+
+    def get_created(self):
+        return Token.objects.get(pk=self.token.pk).created
+
+    def test_expired(self):
+        self.set_created(timezone.now() - settings.TOKEN_EXPIRATION - timedelta(seconds=1))
+        self.assertEqual(self.client.get('/api/v1/posts/').status_code, 401)
+        self.assertFalse(Token.objects.exists())
+
+    def test_renewal(self):
+        self.set_created(timezone.now() - settings.TOKEN_RENEWAL_INTERVAL - timedelta(seconds=1))
+        self.assertEqual(self.client.get('/api/v1/posts/').status_code, 200)
+        renewed = self.get_created()
+        self.assertGreater(renewed, timezone.now() - timedelta(seconds=10))
+        self.assertEqual(self.client.get('/api/v1/posts/').status_code, 200)
+        self.assertEqual(self.get_created(), renewed)
+
+    def test_login_renewal(self):
+        self.set_created(timezone.now() - settings.TOKEN_RENEWAL_INTERVAL - timedelta(seconds=1))
+        token = get_valid_token(self.user)
+        self.assertEqual(token.key, self.token.key)
+        self.assertEqual(get_valid_token(self.user).created, token.created)
+        self.assertEqual(self.get_created(), token.created)
+
+        self.set_created(timezone.now() - settings.TOKEN_EXPIRATION - timedelta(seconds=1))
+        self.assertNotEqual(get_valid_token(self.user).key, self.token.key)
+
+    def test_deleted_elsewhere(self):
+        self.assertEqual(self.client.get('/api/v1/posts/').status_code, 200)
+        cache_key = CachedTokenAuthentication.get_cache_key(self.token.key)
+        cached = cache.get(cache_key)
+        self.token.delete()
+        # Another process still has the token in its cache
+        cache.set(cache_key, cached)
+        CachedTokenAuthentication.revoked_tokens.refreshed_at = 0
+        self.assertEqual(self.client.get('/api/v1/posts/').status_code, 401)
+
+    def test_purge(self):
+        expired_user = User.objects.create_user('expired')
+        expired = Token.objects.create(user=expired_user)
+        Token.objects.filter(pk=expired.pk).update(
+            created=timezone.now() - settings.TOKEN_EXPIRATION - timedelta(seconds=1))
+        old = RevokedToken.objects.create(digest='old')
+        RevokedToken.objects.filter(pk=old.pk).update(revoked=timezone.now() - timedelta(days=2))
+        recent = RevokedToken.objects.create(digest='recent')
+
+        call_command('purge_expired_tokens', stdout=StringIO())
+        self.assertEqual(list(Token.objects.values_list('key', flat=True)), [self.token.key])
+        self.assertEqual(list(RevokedToken.objects.values_list('pk', flat=True)), [recent.pk])
+        self.assertEqual(self.client.get('/api/v1/posts/').status_code, 200)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SocialLoginTest(TransactionTestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def login(self, external_id, network='vk', email=None, username='Social User'):
+        return self.client.post('/api/v1/auth/social_login/', {
+            'id': external_id, 'network': network, 'email': email, 'username': username}, format='json')
+
+    def create_user(self, username, email='', network=None, external_id=None):
+        user = User.objects.create_user(username, email)
+        if network:
+            SocialAccount.objects.create(user=user, network=network, external_id=external_id)
+        return user
+
+    def test_existing_account(self):
+        user = self.create_user('user', 'user@example.com', 'vk', '1')
+        token = Token.objects.create(user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.login(1, email='user@example.com')
+        # The lookup and the last_login update, SQLite also logs its BEGIN
+        self.assertEqual(len([query for query in queries if query['sql'] != 'BEGIN']), 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['auth_token'], token.key)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_existing_email(self):
+        user = self.create_user('user', 'user@example.com', 'vk', '1')
+        response = self.login(2, network='facebook', email='user@example.com')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['auth_token'], Token.objects.get(user=user).key)
+        self.assertEqual(set(user.social_accounts.values_list('network', 'external_id')), {('vk', '1'), ('facebook', '2')})
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_conflict(self):
+        self.create_user('account', '', 'vk', '1')
+        self.create_user('email', 'user@example.com')
+        response = self.login(1, email='user@example.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Token.objects.exists())
+
+    def test_new_user(self):
+        self.create_user('Social User')
+        response = self.login(1, email='user@example.com')
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(email='user@example.com')
+        self.assertEqual(user.username, 'Social User1')
+        self.assertEqual(response.data['auth_token'], user.auth_token.key)
+        self.assertEqual(list(user.social_accounts.values_list('network', 'external_id')), [('vk', '1')])
+        self.assertFalse(user.user_profile.email_confirmed)
+        # The activation email for the new address
+        self.assertEqual(list(OutgoingEmail.objects.values_list('to_email', flat=True)), ['user@example.com'])
+
+        response = self.login(1)
+        self.assertEqual(response.data['auth_token'], user.auth_token.key)
+        self.assertEqual(User.objects.count(), 2)
+
+    def test_concurrent_first_login(self):
+        get_social_token = SocialLogin.get_social_token
+        calls = []
+
+        def concurrent_login(view, *args):
+            calls.append(args)
+            if len(calls) == 1:
+                # Another request created the account first
+                raise IntegrityError
+            return get_social_token(view, *args)
+
+        with patch.object(SocialLogin, 'get_social_token', concurrent_login):
+            response = self.login(1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+
+
+class RecordingEmailBackend(locmem.EmailBackend):
+    in_atomic_block = []
+
+    def send_messages(self, messages):
+        self.in_atomic_block.append(connection.in_atomic_block)
+        return super().send_messages(messages)
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError('Unable to send')
+
+
+@override_settings(EMAIL_BACKEND='main.tests.RecordingEmailBackend')
+class OutgoingEmailTest(TransactionTestCase):
+    def setUp(self):
+        RecordingEmailBackend.in_atomic_block = []
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.author.user_profile.comments_email_mode = COMMENTS_EMAIL_HOURLY
+        self.author.user_profile.save()
+        self.post = Post.objects.create(user=self.author, username=self.author.username, body='body')
+        self.client = APIClient()
+        for i in range(2):
+            response = self.client.post('/api/v1/comments/', {'post': self.post.pk, 'body': 'comment {}'.format(i)},
+                                        format='json')
+            self.assertEqual(response.status_code, 201)
+        OutgoingEmail.objects.update(send_after=timezone.now())
+
+    def test_digest(self):
+        self.assertEqual(OutgoingEmail.send_pending(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(RecordingEmailBackend.in_atomic_block, [False])
+        self.assertEqual(set(OutgoingEmail.objects.values_list('status', 'attempts')), {(EMAIL_SENT, 1)})
+        self.assertEqual(OutgoingEmail.send_pending(), (0, 0))
+
+    def test_deleted_comment(self):
+        Comment.objects.get(body='comment 0').delete()
+        self.assertEqual(OutgoingEmail.send_pending(), (1, 0))
+        self.assertNotIn('comment 0', mail.outbox[0].body)
+        self.assertIn('comment 1', mail.outbox[0].body)
+
+    def test_all_comments_deleted(self):
+        Comment.objects.all().delete()
+        self.assertEqual(OutgoingEmail.send_pending(), (0, 1))
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(set(OutgoingEmail.objects.values_list('status', 'attempts')), {(EMAIL_FAILED, 1)})
+
+    def test_claimed(self):
+        self.assertEqual(len(OutgoingEmail.claim_pending()), 1)
+        self.assertEqual(OutgoingEmail.claim_pending(), [])
+        self.assertEqual(OutgoingEmail.send_pending(), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='main.tests.FailingEmailBackend')
+    def test_retry(self):
+        self.assertEqual(OutgoingEmail.send_pending(max_attempts=2), (0, 1))
+        self.assertEqual(set(OutgoingEmail.objects.values_list('status', 'attempts')), {(EMAIL_PENDING, 1)})
+        self.assertFalse(OutgoingEmail.objects.filter(send_after__lte=timezone.now()).exists())
+
+        OutgoingEmail.objects.update(send_after=timezone.now())
+        self.assertEqual(OutgoingEmail.send_pending(max_attempts=2), (0, 1))
+        self.assertEqual(set(OutgoingEmail.objects.values_list('status', 'attempts')), {(EMAIL_FAILED, 2)})
@@ -1,72 +1,267 @@
-from main.models import Post, PostMark, Tag, Comment, UserProfile, POST_MARK_LIKE, POST_MARK_DISLIKE, PostVersion, CommentVersion, SocialAccount
-from main.serializers import PostSerializer, UserSerializer, PostMarkSerializer, TagSerializer, CommentSerializer, UserProfileSerializer, SetEmailSerializer
+from main.models import Post, PostMark, PostHistory, Tag, Comment, UserProfile, PostVersion, CommentVersion, SocialAccount, OutgoingEmail, COUNTER_FIELDS, MARK_COUNTERS, COMMENTS_EMAIL_IMMEDIATE, create_user_with_free_username
+from main.serializers import PostSerializer, UserSerializer, PostMarkSerializer, TagSerializer, CommentSerializer, UserProfileSerializer, SetEmailSerializer, VoteSerializer
 from django.contrib.auth.models import User
-from django.db.models import Case, Value, When, IntegerField, Q
+from django.db.models import Value, IntegerField, F, Prefetch, Q, Max, Case, When
+from django.db.models.expressions import RawSQL
 from rest_framework.response import Response
-from rest_framework.authtoken.models import Token
 from django.contrib.auth import user_logged_in
 from djoser.serializers import TokenSerializer
 from rest_framework import filters
-import reversion
-from django.db import transaction
-from .pagination import UnlimitedPagination
+from django.db import models, transaction, connection, IntegrityError
+from django.core.exceptions import ValidationError as DjangoValidationError
+from .pagination import UnlimitedPagination, KeysetPagination
 from djoser.utils import SendEmailViewMixin
 from django.conf import settings
-from djoser.views import ActivationView, RegistrationView
+from djoser.views import ActivationView, RegistrationView, LoginView
 from .tokens import UserActivateTokenGenerator
+from .authentication import get_valid_token
 from rest_framework import generics, status, views, exceptions
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.serializers import ValidationError
+from rest_framework import serializers
+from collections import OrderedDict
 from .permissions import create_permission_for_owner
 from rest_framework import viewsets
-from rest_framework.decorators import detail_route
-from .filters import UserFilter, PostFilter, CommentFilter
-
+from rest_framework.decorators import detail_route, list_route
+from .filters import UserFilter, PostFilter, CommentFilter, PostSearchFilter
+from .cache import get_response_key, get_or_compute
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag, http_date
+import calendar
+from datetime import timedelta
+
+
+class OutboxEmailMixin(SendEmailViewMixin):
+    """
+    Queues the emails into the outbox instead of sending them inline, they
+    are sent by the send_queued_emails command.
+    """
+    def send_email(self, to_email, from_email, context):
+        OutgoingEmail.enqueue(to_email, from_email, context, **self.get_send_email_extras())
+
+
+class TransactionMixin:
+    """
+    Runs the writes in a transaction, reads do not need one.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return super().dispatch(request, *args, **kwargs)
+        with transaction.atomic():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class CachedListMixin:
+    """
+    Caches the list data until one of cache_generations is bumped (see
+    main.cache) and answers a matching If-None-Match with 304.
+    """
+    cache_generations = ()
+    cache_timeout = 24 * 60 * 60
+
+    def list(self, request, *args, **kwargs):
+        key = get_response_key(request, self.cache_generations)
+        etag = quote_etag(key)
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if key in if_none_match or '*' in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        handler = super().list
+        data = get_or_compute('list:{}'.format(key), lambda: handler(request, *args, **kwargs).data, self.cache_timeout)
+        return Response(data, headers={'ETag': etag})
+
+
+class AnonymousCacheMixin:
+    """
+    Anonymous users all get the same list and detail data, it is shared
+    through the cache until one of cache_generations is bumped.
+    """
+    cache_generations = ()
+    cache_timeout = 10 * 60
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.user.is_authenticated():
+            return handler(request, *args, **kwargs)
+        key = 'anonymous:{}'.format(get_response_key(request, self.cache_generations))
+        return Response(get_or_compute(key, lambda: handler(request, *args, **kwargs).data, self.cache_timeout))
+
+
+class ConditionalGetMixin:
+    """
+    Sends ETag and Last-Modified built from get_last_changed(), the latest
+    change of the PostHistory rows the response depends on, and answers
+    If-None-Match/If-Modified-Since with 304 before the list or object
+    query runs. The ETag also varies with the user because of the per-user
+    fields like rated.
+
+    A change is stamped before its transaction commits, so a slow one can
+    become visible without moving the latest change of a list. Lists are
+    therefore validated with the 'posts' generation, bumped on commit,
+    instead of Last-Modified.
+    """
+    def get_last_changed(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def get_lookup_value(self):
+        value = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field, '')
+        return value if value.isdigit() else None
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        changed = self.get_last_changed()
+        if changed is None:
+            return handler(request, *args, **kwargs)
+
+        if self.action == 'retrieve':
+            generations, last_modified = ('tags', ), calendar.timegm(changed.utctimetuple())
+        else:
+            generations, last_modified = ('tags', 'posts'), None
+        etag = get_response_key(request, generations, changed.isoformat(), request.user.pk)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = quote_etag(etag)
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        patch_vary_headers(response, ('Authorization', 'Cookie'))
+        return response
+
+
+class SparseFieldsViewMixin:
+    """
+    ?fields=id,body renders only the listed fields and ?exclude=comments
+    drops the listed ones. get_queryset uses is_field_requested to skip
+    the annotations, joins and prefetches of the fields left out.
+    """
+    fields_query_param = 'fields'
+    exclude_query_param = 'exclude'
+
+    def get_sparse_fields(self):
+        if not hasattr(self, '_sparse_fields'):
+            fields, exclude = None, set()
+            # Writes validate and render the full serializer
+            if self.request.method in ('GET', 'HEAD'):
+                params = self.request.query_params
+                if self.fields_query_param in params:
+                    fields = self._parse_field_names(params[self.fields_query_param])
+                exclude = self._parse_field_names(params.get(self.exclude_query_param, ''))
+            self._sparse_fields = fields, exclude
+        return self._sparse_fields
+
+    def is_field_requested(self, name):
+        fields, exclude = self.get_sparse_fields()
+        return (fields is None or name in fields) and name not in exclude
+
+    def defer_unrequested(self, queryset, *names):
+        deferred = [name for name in names if not self.is_field_requested(name)]
+        return queryset.defer(*deferred) if deferred else queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'], context['exclude'] = self.get_sparse_fields()
+        return context
 
-class ReversionMixin:
-    def dispatch(self, *args, **kwargs):
-        with transaction.atomic(), reversion.create_revision():
-            response = super().dispatch(*args, **kwargs)
-            if not self.request.user.is_anonymous():
-                reversion.set_user(self.request.user)
-            return response
+    def _parse_field_names(self, value):
+        return {name.strip() for name in value.split(',') if name.strip()}
 
 
-class PostViewSet(ReversionMixin, viewsets.ModelViewSet):
+class PostViewSet(TransactionMixin, ConditionalGetMixin, AnonymousCacheMixin, SparseFieldsViewMixin, viewsets.ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
-    filter_backends = (filters.DjangoFilterBackend,)
+    filter_backends = (filters.DjangoFilterBackend, PostSearchFilter)
     filter_class = PostFilter
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-last_action', '-id')
+    changes_ordering = ('changed', 'id')
+    changes_overlap = timedelta(seconds=60)
+    since_query_param = 'since'
+    cache_generations = ('posts', 'tags')
+    comments_limit_query_param = 'comments_limit'
+    max_rate_batch_size = 100
 
     def get_queryset(self):
-        queryset = Post.objects.order_by('-history__last_action')
-        user = self.request.user
-        if user.is_authenticated():
-            queryset = queryset.annotate(
-                rated=Case(
-                    When(Q(marks__user=user, marks__mark_type=POST_MARK_LIKE), then=Value(POST_MARK_LIKE)),
-                    When(Q(marks__user=user, marks__mark_type=POST_MARK_DISLIKE), then=Value(POST_MARK_DISLIKE)),
-                    default=Value(0),
-                    output_field=IntegerField())).exclude(Q(marks__user=user) & Q(rated=0))
+        tag_alias = self.request.query_params.get('tags__alias')
+        if tag_alias:
+            # Filtered before annotating so that both use the same PostTagActivity join
+            queryset = Post.objects.filter(tag_activity__tag__alias=tag_alias)\
+                .annotate(last_action=F('tag_activity__last_action'))
         else:
-            queryset = queryset.annotate(
-                rated=Case(
-                    default=Value(0),
-                    output_field=IntegerField()))
-
-        queryset = queryset.distinct()
+            queryset = Post.objects.annotate(last_action=F('history__last_action'))
+        queryset = queryset.order_by(*self.keyset_ordering)
+        queryset = self.defer_unrequested(queryset, 'body', 'email')
+        if self.is_field_requested('rated'):
+            queryset = queryset.annotate(rated=self.get_rated_expression(self.request.user))
+
+        if self.action in ('list', 'retrieve', 'changes') and self.is_field_requested('tags'):
+            queryset = queryset.prefetch_related(Prefetch('tags', queryset=Tag.objects.only('id')))
+        # A single post reads its latest comments with a LIMIT query instead
+        if self.action in ('list', 'changes') and self.get_comments_limit():
+            queryset = queryset.prefetch_related(Prefetch('comments', queryset=Comment.objects.only('id', 'post')))
         return queryset
 
+    @property
+    def keyset_only(self):
+        return self.action == 'changes'
+
+    def get_keyset_ordering(self):
+        if self.action == 'changes':
+            return self.changes_ordering
+        if PostSearchFilter.get_search_query(self.request):
+            return PostSearchFilter.ordering
+        return self.keyset_ordering
+
+    def get_last_changed(self):
+        if self.action == 'retrieve':
+            return PostHistory.last_changed(post=self.get_lookup_value())
+        return PostHistory.last_changed()
+
+    def get_rated_expression(self, user):
+        if not user.is_authenticated():
+            return Value(0, output_field=IntegerField())
+        # One lookup on the (post, user) index per post instead of joining all the marks
+        return RawSQL(
+            'COALESCE((SELECT U0.mark_type FROM {mark} U0 WHERE U0.post_id = {post}.id AND U0.user_id = %s LIMIT 1), 0)'.format(
+                mark=connection.ops.quote_name(PostMark._meta.db_table),
+                post=connection.ops.quote_name(Post._meta.db_table)),
+            (user.pk, ),
+            output_field=IntegerField())
+
+    def get_comments_limit(self):
+        """
+        Number of the latest comment ids embedded in each post. The list omits
+        them unless asked with ?comments_limit=N, the comments endpoint
+        serves them instead.
+        """
+        if not self.is_field_requested('comments'):
+            return 0
+        max_limit = self.get_serializer_class().max_comments_limit
+        fields, exclude = self.get_sparse_fields()
+        default = 0 if self.action in ('list', 'changes') and fields is None else max_limit
+        try:
+            limit = int(self.request.query_params[self.comments_limit_query_param])
+        except (KeyError, ValueError):
+            return default
+        return min(max(limit, 0), max_limit)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['comments_limit'] = self.get_comments_limit()
+        return context
+
     def save_version(self, serializer):
-        post = serializer.instance
-        post_version = PostVersion.objects.create(
-            post=post,
-            user=post.user,
-            username=post.username,
-            body=post.body,
-            email=post.email
-        )
-        for tag in post.tags.all():
-            post_version.tags.add(tag)
+        PostVersion.create_for(serializer.instance)
 
     def perform_update(self, serializer):
         super().perform_update(serializer)
@@ -88,37 +283,129 @@ class PostViewSet(ReversionMixin, viewsets.ModelViewSet):
         post = self.get_object()
         if user.is_authenticated() and user == post.user:
             raise exceptions.PermissionDenied(detail='Unable to rate own post')
-        user = self.request.user
+        if not user.is_authenticated():
+            raise exceptions.NotAuthenticated()
         mark_type = request.data['rated']
-        create = True
         if mark_type:
-            existing_marks = PostMark.objects.filter(user=user, post=post)
-            if existing_marks.count() > 1:
-                existing_marks.delete()
-            elif existing_marks.count() == 1:
-                existing_mark = existing_marks[0]
-                if existing_mark.mark_type == mark_type:
-                    existing_mark.delete()
-                    create = False
-                    post.rated = 0
-            if create:
-                post_mark, created = PostMark.objects.get_or_create(user=user, post=post,
-                                                                    mark_type=mark_type)
-                post.rated = mark_type
+            if mark_type not in MARK_COUNTERS:
+                raise ValidationError({'rated': 'Unknown mark type'})
+            post.rated = PostMark.rate(post, user, mark_type)
+            post.refresh_from_db(fields=COUNTER_FIELDS)
 
         serializer = PostSerializer(post)
 
         return Response(serializer.data)
 
+    @list_route(('POST', ))
+    def rate_batch(self, request, *args, **kwargs):
+        """
+        Applies a list of {"post": id, "rated": mark} votes of the current user
+        in one transaction, e.g. the votes queued by an offline client.
+        """
+        user = request.user
+        if not user.is_authenticated():
+            raise exceptions.NotAuthenticated()
+        serializer = VoteSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        votes = [(vote['post'], vote['rated']) for vote in serializer.validated_data]
+        if len(votes) > self.max_rate_batch_size:
+            raise ValidationError('Too many votes, at most {} are allowed'.format(self.max_rate_batch_size))
+
+        post_ids = {post_id for post_id, mark_type in votes}
+        owners = dict(Post.objects.filter(pk__in=post_ids).values_list('pk', 'user'))
+        if post_ids - set(owners):
+            raise ValidationError('Unknown posts: {}'.format(sorted(post_ids - set(owners))))
+        if user.pk in owners.values():
+            raise exceptions.PermissionDenied(detail='Unable to rate own post')
+
+        rated = PostMark.rate_many(user, votes)
+        posts = Post.objects.filter(pk__in=post_ids).order_by('pk').values('id', 'liked_count', 'disliked_count')
+        return Response([dict(post, rated=rated[post['id']]) for post in posts])
+
+    @list_route()
+    def changes(self, request, *args, **kwargs):
+        """
+        Posts changed (edited, commented or rated) after ?since=<ISO time>,
+        oldest change first, with the comments created on them since then.
+        The response cursor is passed back as ?cursor= for the next page or
+        the next poll, so that it transfers only what changed in between. It
+        also carries the lower bound of the comments, which stays the same
+        over the pages of one poll, and the latest change seen.
+
+        A change is stamped before its transaction commits, so a slow one
+        can become visible after a later stamp was already returned. Each
+        poll therefore goes back changes_overlap before the latest change
+        seen and returns those posts and comments again, clients replace
+        them by id.
+        """
+        since = request.query_params.get(self.since_query_param)
+        if not since and not request.query_params.get(self.paginator.cursor_query_param):
+            raise ValidationError('Either {} or {} is required'.format(self.since_query_param,
+                                                                       self.paginator.cursor_query_param))
+
+        queryset = self.filter_queryset(self.get_queryset()).annotate(changed=F('history__changed'))
+        if since:
+            since = serializers.DateTimeField().to_internal_value(since)
+            queryset = queryset.filter(changed__gt=since)
+
+        posts = self.paginate_queryset(queryset)
+        latest = since
+        if self.paginator.start_position is not None:
+            since, latest = self.get_cursor_bounds()
+        comments = Comment.objects.filter(post__in=[post.pk for post in posts], created__gt=since)\
+            .order_by('created', 'id')
+
+        if posts:
+            latest = max(latest, self.paginator.position[0])
+        if self.paginator.has_next:
+            cursor = list(self.paginator.position) + [since, latest]
+        else:
+            start = latest - self.changes_overlap
+            cursor = [start, 0, start, latest]
+        return Response(OrderedDict([
+            ('cursor', self.paginator.encode_cursor(cursor)),
+            ('more', self.paginator.has_next),
+            ('posts', self.get_serializer(posts, many=True).data),
+            ('comments', CommentSerializer(comments, many=True, context=self.get_comments_context()).data),
+        ]))
+
+    def get_comments_context(self):
+        # ?fields= and ?exclude= name the post fields
+        context = self.get_serializer_context()
+        context['fields'], context['exclude'] = None, ()
+        return context
 
-class UserViewSet(viewsets.ModelViewSet):
+    def get_cursor_bounds(self):
+        """
+        The lower bound of the comments and the latest change seen, kept in
+        the cursor after its position. A cursor without them starts both at
+        its position.
+        """
+        try:
+            bounds = [models.DateTimeField().to_python(value) for value in self.paginator.cursor_extra[:2]]
+        except (DjangoValidationError, TypeError):
+            bounds = [None]
+        if None in bounds:
+            raise exceptions.NotFound(self.paginator.invalid_cursor_message)
+        return bounds + [self.paginator.start_position[0]] * (2 - len(bounds))
+
+
+class UserViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     filter_class = UserFilter
     filter_backends = (filters.DjangoFilterBackend,)
     serializer_class = UserSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.is_field_requested('posts'):
+            queryset = queryset.prefetch_related(Prefetch('posts', queryset=Post.objects.only('id', 'user')))
+        if self.is_field_requested('comments'):
+            queryset = queryset.prefetch_related(Prefetch('comments', queryset=Comment.objects.only('id', 'user')))
+        return queryset
 
-class PostMarkViewSet(viewsets.ModelViewSet):
+
+class PostMarkViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     queryset = PostMark.objects.all()
     serializer_class = PostMarkSerializer
 
@@ -126,33 +413,41 @@ class PostMarkViewSet(viewsets.ModelViewSet):
         user = self.request.user
         post_mark.save(user=user)
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(CachedListMixin, SparseFieldsViewMixin, viewsets.ModelViewSet):
     serializer_class = TagSerializer
     queryset = Tag.objects.all()
     pagination_class = UnlimitedPagination
+    cache_generations = ('tags', )
 
 
-class CommentViewSet(ReversionMixin, viewsets.ModelViewSet):
+class CommentViewSet(TransactionMixin, ConditionalGetMixin, AnonymousCacheMixin, SparseFieldsViewMixin, OutboxEmailMixin, viewsets.ModelViewSet):
     serializer_class = CommentSerializer
     filter_backends = (filters.DjangoFilterBackend,)
     filter_class = CommentFilter
     queryset = Comment.objects.all()
     permission_classes = (create_permission_for_owner(included_methods=('PUT', 'PATCH')), )
+    cache_generations = ('posts', )
 
     subject_template_name = 'comments_email_subject.txt'
     plain_body_template_name = 'comments_email_body.txt'
     html_body_template_name = 'comments_email_body.html'
+    digest_subject_template_name = 'comments_digest_email_subject.txt'
+    digest_plain_body_template_name = 'comments_digest_email_body.txt'
+    digest_html_body_template_name = 'comments_digest_email_body.html'
+
+    def get_queryset(self):
+        return self.defer_unrequested(super().get_queryset(), 'body', 'email')
+
+    def get_last_changed(self):
+        if self.action == 'retrieve':
+            return PostHistory.last_changed(post__comments=self.get_lookup_value())
+        post = self.request.query_params.get('post', '')
+        if post.isdigit():
+            return PostHistory.last_changed(post=post)
+        return PostHistory.last_changed()
 
     def save_version(self, serializer):
-        comment = serializer.instance
-        comment_version = CommentVersion.objects.create(
-            comment=comment,
-            post=comment.post,
-            user=comment.user,
-            username=comment.username,
-            body=comment.body,
-            email=comment.email
-        )
+        CommentVersion.create_for(serializer.instance)
 
     def perform_create(self, serializer):
         if self.request.user.is_authenticated():
@@ -163,10 +458,14 @@ class CommentViewSet(ReversionMixin, viewsets.ModelViewSet):
 
         comment = serializer.instance
 
-        post_user = comment.post.user
-        user_profile = post_user.user_profile
-        if user != post_user and user_profile.receive_comments_email:
-            self.send_email(**self.get_send_email_kwargs(post_user, comment))
+        # The author with the profile in one query
+        post_user = User.objects.select_related('user_profile').filter(pk=comment.post.user_id).first()
+        if post_user and post_user != comment.user and post_user.email \
+                and post_user.user_profile.receive_comments_email:
+            if post_user.user_profile.comments_email_mode == COMMENTS_EMAIL_IMMEDIATE:
+                self.send_email(**self.get_send_email_kwargs(post_user, comment))
+            else:
+                self.send_digest_email(post_user, comment)
 
         self.save_version(serializer)
 
@@ -174,6 +473,21 @@ class CommentViewSet(ReversionMixin, viewsets.ModelViewSet):
         super().perform_update(serializer)
         self.save_version(serializer)
 
+    def send_digest_email(self, user, comment):
+        """
+        Queues the notification into the user's current digest, all of them
+        are sent as one email when the hour or the day is over.
+        """
+        send_after = user.user_profile.get_next_digest_time()
+        OutgoingEmail.enqueue(
+            subject_template_name=self.digest_subject_template_name,
+            plain_body_template_name=self.digest_plain_body_template_name,
+            html_body_template_name=self.digest_html_body_template_name,
+            send_after=send_after,
+            digest='comments:{}:{}'.format(user.pk, send_after.isoformat()),
+            **self.get_send_email_kwargs(user, comment)
+        )
+
     def get_send_email_kwargs(self, user, comment):
         return {
             'from_email': getattr(settings, 'DEFAULT_FROM_EMAIL', None),
@@ -205,7 +519,7 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
         return obj
 
 
-class SendActivationEmailView(views.APIView, SendEmailViewMixin):
+class SendActivationEmailView(views.APIView, OutboxEmailMixin):
     subject_template_name = 'activation_email_subject.txt'
     plain_body_template_name = 'activation_email_body.txt'
     token_generator = UserActivateTokenGenerator()
@@ -229,45 +543,53 @@ class SendActivationEmailView(views.APIView, SendEmailViewMixin):
 
 class SocialLoginMixin:
     def login_user(self, id, network, email, username):
-        users_by_id = User.objects.filter(social_accounts__external_id=id, social_accounts__network=network)
-        if email:
-            users_by_email = User.objects.filter(email=email)
-        user = None
+        # A concurrent first login of the same account fails on the
+        # (network, external_id) constraint and finds that account on retry
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    token = self.get_social_token(str(id), network, email, username)
+                break
+            except IntegrityError:
+                if attempt:
+                    raise
+
+        user_logged_in.send(sender=token.user.__class__, request=self.request, user=token.user)
+        return Response(
+            data=TokenSerializer(token).data,
+            status=status.HTTP_200_OK,
+        )
 
-        if users_by_id.exists() and email and users_by_email.exists() and users_by_id[0].pk != users_by_email[0].pk:
+    def get_social_token(self, external_id, network, email, username):
+        """
+        Finds the users with the social account or the email in one query,
+        together with their profile and token, then creates whatever is
+        missing.
+        """
+        by_account = Q(social_accounts__network=network, social_accounts__external_id=external_id)
+        users = User.objects.filter(by_account | Q(email=email) if email else by_account)\
+            .annotate(has_account=Max(Case(When(by_account, then=Value(1)), default=Value(0),
+                                           output_field=IntegerField())))\
+            .select_related('user_profile', 'auth_token').order_by('-has_account', 'pk')
+        users = list(users)
+        account_user = next((user for user in users if user.has_account), None)
+        email_user = next((user for user in users if email and user.email == email), None)
+        if account_user and email_user and account_user.pk != email_user.pk:
             raise ValidationError('Пользователь с электронным адресом этой соцсети уже зарегистрирован')
-        elif users_by_id.exists():
-            user = users_by_id[0]
-        elif users_by_email.exists():
-            user = users_by_email[0]
-
-        if not user:
-            users_by_username = User.objects.filter(username=username)
-            k = 0
-            while users_by_username.exists():
-                k += 1
-                username += str(k)
-                users_by_username = User.objects.filter(username=username)
-            user = User.objects.create(username=username)
 
+        user = account_user or email_user
+        if user is None:
+            user = create_user_with_free_username(username)
         if email and user.email != email:
             user.email = email
-            user.save()
+            user.save(update_fields=['email'])
             self.send_email(**self.get_send_email_kwargs(user))
 
-        social_account, _ = SocialAccount.objects.get_or_create(user=user)
-        social_account.external_id = id
-        social_account.network = network
-        social_account.save()
-
-        user_profile, _ = UserProfile.objects.get_or_create(user=user)
-
-        token, _ = Token.objects.get_or_create(user=user)
-        user_logged_in.send(sender=user.__class__, request=self.request, user=user)
-        return Response(
-            data=TokenSerializer(token).data,
-            status=status.HTTP_200_OK,
-        )
+        if user is not account_user:
+            SocialAccount.objects.bulk_create([SocialAccount(user=user, network=network, external_id=external_id)])
+        if getattr(user, 'user_profile', None) is None:
+            UserProfile.objects.get_or_create(user=user)
+        return get_valid_token(user, getattr(user, 'auth_token', None))
 
 class SocialLogin(SendActivationEmailView, SocialLoginMixin):
 
@@ -303,6 +625,17 @@ class VkLogin(SendActivationEmailView, SocialLoginMixin):
                 return self.login_user(user_id, network, email, username)
 
 
+class LoginViewWithExpiringToken(LoginView):
+    def action(self, serializer):
+        user = serializer.user
+        token = get_valid_token(user)
+        user_logged_in.send(sender=user.__class__, request=self.request, user=user)
+        return Response(
+            data=TokenSerializer(token).data,
+            status=status.HTTP_200_OK,
+        )
+
+
 class ActivationViewWithToken(ActivationView):
     token_generator = UserActivateTokenGenerator()
 
@@ -312,7 +645,7 @@ class ActivationViewWithToken(ActivationView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class RegistrationViewWithToken(RegistrationView):
+class RegistrationViewWithToken(OutboxEmailMixin, RegistrationView):
     token_generator = UserActivateTokenGenerator()
 
 